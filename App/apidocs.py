@@ -0,0 +1,81 @@
+import gzip
+import hashlib
+import json
+import logging
+from threading import Lock
+from flask import Flask, Response, request
+
+
+SPEC_PATH = "../openapi3_0.json"
+
+# url prefixes served by the swagger ui, everything else goes to the api
+DOCS_PREFIXES = ("/apidocs", "/flasgger_static")
+
+
+# serialized spec, built once on first use
+class Spec:
+    def __init__(self, path: str):
+        with open(path) as json_file:
+            spec = json.load(json_file)
+
+        self.body = json.dumps(spec, separators=(",", ":")).encode()
+        self.gzipped = gzip.compress(self.body, compresslevel=9)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        logging.info(
+            f"OpenAPI spec loaded: {len(self.body)} bytes, {len(self.gzipped)} gzipped"
+        )
+
+
+spec = None
+spec_lock = Lock()
+
+
+def get_spec() -> Spec:
+    global spec
+    with spec_lock:
+        if spec is None:
+            spec = Spec(SPEC_PATH)
+    return spec
+
+
+def spec_response() -> Response:
+    current = get_spec()
+
+    if "gzip" in request.accept_encodings:
+        response = Response(current.gzipped, mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+        response.set_etag(f"{current.etag}-gzip")
+    else:
+        response = Response(current.body, mimetype="application/json")
+        response.set_etag(current.etag)
+
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "no-cache"  # always revalidate the etag
+
+    # answers If-None-Match with 304
+    return response.make_conditional(request)
+
+
+# WSGI middleware that builds the swagger ui (and imports flasgger) on first use
+class LazySwagger:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.docs_app = None
+        self.lock = Lock()
+
+    def get_docs_app(self):
+        with self.lock:
+            if self.docs_app is None:
+                from flasgger import Swagger
+
+                # the ui loads /apispec_1.json, which is still served by the api
+                docs_app = Flask(__name__)
+                Swagger(docs_app)
+                self.docs_app = docs_app
+                logging.info("Swagger UI initialised.")
+        return self.docs_app
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO", "").startswith(DOCS_PREFIXES):
+            return self.get_docs_app()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
@@ -0,0 +1,248 @@
+# Benchmarks for the query layer, run against any supported backend
+# usage: BENCH_DATABASE_URL=<url> BENCH_USERS=<n> python benchmark.py
+# in-memory read model against sql: python benchmark.py readmodel
+# startup (import time and time to first request): python benchmark.py startup
+# write throughput as the shard count grows: python benchmark.py shards
+import logging
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from flask import Flask
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from models import Base, DATABASE_URL, create_search_indexes
+from storage import USER_COLUMNS
+import readmodel
+import shards
+from rebalance import prepare
+from sketches import build_sketches
+from queries import (
+    search_users,
+    search_user_by_id,
+    get_user_statistics,
+    create_users,
+)
+
+
+BENCH_DATABASE_URL = os.environ.get(
+    "BENCH_DATABASE_URL", "sqlite:///../Database/benchmark.db"
+)
+BENCH_USERS = int(os.environ.get("BENCH_USERS", 10000))
+BENCH_ROUNDS = int(os.environ.get("BENCH_ROUNDS", 20))
+# shard benchmark: concurrent writers, users per request, shard counts to compare
+BENCH_WRITERS = int(os.environ.get("BENCH_WRITERS", 8))
+BENCH_BATCH = int(os.environ.get("BENCH_BATCH", 1))
+BENCH_SHARDS = [int(n) for n in os.environ.get("BENCH_SHARDS", "1,2,4,8").split(",")]
+
+# run in a fresh interpreter, like a newly spawned worker
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+from run import app
+imported = time.perf_counter()
+app.test_client().get("/apispec_1.json")
+print(imported - start, time.perf_counter() - start)
+"""
+
+CITIES = ["New Orleans", "Brighton", "Bridgeport", "Anchorage", "Hamilton", "Ashland"]
+STATES = ["LA", "MI", "NJ", "AK", "OH", "PA"]
+COMPANIES = ["Benton, John B Jr", "Chanay, Jeffrey A Esq", "Feltz Printing Service"]
+
+
+def make_users(count: int, start: int = 1) -> list[dict]:
+    rng = random.Random(start)
+    return [
+        {
+            "id": id_,
+            "first_name": f"First{id_}",
+            "last_name": f"Last{id_}",
+            "company_name": rng.choice(COMPANIES),
+            "city": rng.choice(CITIES),
+            "state": rng.choice(STATES),
+            "zip": rng.randint(10000, 99999),
+            "email": f"user{id_}@example.com",
+            "web": f"http://www.user{id_}.com",
+            "age": rng.randint(1, 90),
+        }
+        for id_ in range(start, start + count)
+    ]
+
+
+def timed(name: str, rounds: int, function, *args):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function(*args)
+    elapsed = (time.perf_counter() - start) / rounds
+    print(f"{name:<40}{elapsed * 1000:>10.3f} ms")
+    return elapsed
+
+
+def time_reads(session: Session, label: str = ""):
+    timed(f"search_users (page){label}", BENCH_ROUNDS, search_users, session)
+    timed(
+        f"search_users (search){label}",
+        BENCH_ROUNDS,
+        search_users,
+        session,
+        "orlea",
+        "-age",
+    )
+    timed(
+        f"search_user_by_id{label}",
+        BENCH_ROUNDS,
+        search_user_by_id,
+        session,
+        BENCH_USERS // 2,
+    )
+    timed(f"get_user_statistics{label}", BENCH_ROUNDS, get_user_statistics, session)
+
+
+def main(with_read_model: bool = False):
+    # the benchmark drops its tables, never run it on the app's database
+    if BENCH_DATABASE_URL == DATABASE_URL:
+        sys.exit(
+            "BENCH_DATABASE_URL is the app database (DATABASE_URL), use another one."
+        )
+    engine = create_engine(BENCH_DATABASE_URL)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    create_search_indexes(engine)
+
+    # jsonify needs an application context
+    app = Flask(__name__)
+    print(f"backend: {engine.dialect.name}, users: {BENCH_USERS}")
+
+    with app.app_context(), Session(engine) as session:
+        timed("create_users", 1, create_users, make_users(BENCH_USERS), session)
+        time_reads(session)
+
+        timed(
+            "create_users (100)",
+            BENCH_ROUNDS,
+            lambda: create_users(make_users(100, BENCH_USERS + 1), session, "update"),
+        )
+        timed("build_sketches", 1, build_sketches, session)
+        timed(
+            "get_user_statistics (approx)",
+            BENCH_ROUNDS,
+            get_user_statistics,
+            session,
+            True,
+        )
+        timed(
+            "create_users (100, with sketches)",
+            BENCH_ROUNDS,
+            lambda: create_users(make_users(100, BENCH_USERS + 1), session, "update"),
+        )
+
+        if with_read_model:
+            # memory of the snapshot including a sorted index on every column
+            tracemalloc.start()
+            snapshot = readmodel.load(session)
+            for column in USER_COLUMNS:
+                snapshot.index(column)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(
+                f"{'read model memory':<40}{size / 2**20:>10.1f} MB "
+                f"({size / 2**20 * 1_000_000 / BENCH_USERS:.0f} MB per 1M users)"
+            )
+            del snapshot
+
+            readmodel.READ_MODEL = True
+            readmodel.engine = engine
+            timed("read model load", 1, readmodel.refresh)
+            time_reads(session, " (read model)")
+
+    Base.metadata.drop_all(engine)
+    engine.dispose()
+
+
+def use_shards(urls: list[str]):
+    shards.engines = [create_engine(url) for url in urls]
+
+
+def write_batch(batch: list[dict]) -> int:
+    with Flask(__name__).app_context(), Session(shards.engines[0]) as session:
+        return create_users(batch, session)[1]
+
+
+# POST /api/users from concurrent writer processes (like app workers),
+# one sqlite file per shard
+def shard_writes():
+    users = make_users(BENCH_USERS)
+    batches = [users[i : i + BENCH_BATCH] for i in range(0, len(users), BENCH_BATCH)]
+    print(
+        f"users: {BENCH_USERS}, writers: {BENCH_WRITERS}, "
+        f"users per request: {BENCH_BATCH}, cpus: {os.cpu_count()}"
+    )
+
+    for count in BENCH_SHARDS:
+        urls = [f"sqlite:///../Database/benchmark_shard{n}.db" for n in range(count)]
+        use_shards(urls)
+        for engine in shards.engines:
+            Base.metadata.drop_all(engine)
+            prepare(engine)
+
+        with multiprocessing.Pool(BENCH_WRITERS, use_shards, (urls,)) as pool:
+            start = time.perf_counter()
+            codes = pool.map(write_batch, batches, chunksize=1)
+            elapsed = time.perf_counter() - start
+
+        failed = sum(not code == 200 for code in codes)
+        print(
+            f"{f'{count} shard(s)':<40}{BENCH_USERS / elapsed:>10.0f} users/s"
+            + (f" ({failed} requests failed)" if failed else "")
+        )
+        for engine in shards.engines:
+            Base.metadata.drop_all(engine)
+            engine.dispose()
+
+
+def startup():
+    imports, first_requests = [], []
+    for _ in range(BENCH_ROUNDS):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+        imports.append(float(output[0]))
+        first_requests.append(float(output[1]))
+
+    print(f"{'import run':<40}{min(imports) * 1000:>10.3f} ms")
+    print(f"{'time to first request':<40}{min(first_requests) * 1000:>10.3f} ms")
+
+    # slowest imports done by run.py, from python -X importtime
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import run"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    imported_by_run = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            imported_by_run.append((int(cumulative), name.strip()))
+
+    for cumulative, name in sorted(imported_by_run, reverse=True)[:8]:
+        print(f"  {name:<30}{cumulative / 1000:>10.3f} ms")
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    if sys.argv[1:] == ["startup"]:
+        startup()
+    elif sys.argv[1:] == ["shards"]:
+        shard_writes()
+    else:
+        main(with_read_model=sys.argv[1:] == ["readmodel"])
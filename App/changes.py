@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+from flask import jsonify, Response
+from sqlalchemy import delete, event, func, insert, select, update
+from sqlalchemy.orm import Session
+from models import User, UserChange, ChangeCounter, engine
+from storage import USER_COLUMNS
+import shards
+
+
+# change log entries older than this are dropped, consumers behind it must resync
+CHANGE_LOG_RETENTION = timedelta(
+    days=float(os.environ.get("CHANGE_LOG_RETENTION_DAYS", "7"))
+)
+# compaction and retention run after this many commits in a process
+CHANGE_LOG_MAINTAIN_EVERY = int(os.environ.get("CHANGE_LOG_MAINTAIN_EVERY", "1000"))
+# server-sent events: seconds between polls, and how long a stream stays open
+CHANGE_STREAM_POLL_INTERVAL = float(os.environ.get("CHANGE_STREAM_POLL_INTERVAL", "1"))
+CHANGE_STREAM_MAX_SECONDS = float(os.environ.get("CHANGE_STREAM_MAX_SECONDS", "300"))
+CHANGE_STREAM_KEEP_ALIVE = 15
+
+# commits with user changes made by this process
+local_commits = 0
+commits_lock = Lock()
+
+
+# log changed users in the current transaction, op is "upsert" or "delete"
+def record_change(session: Session, ids: list, op: str = "upsert"):
+    # the counter row lock serializes writers, so sequences commit in order
+    bumped = session.execute(
+        update(ChangeCounter)
+        .where(ChangeCounter.name == "user")
+        .values(value=ChangeCounter.value + 1)
+    ).rowcount
+    if not bumped:
+        session.add(ChangeCounter(name="user", value=1))
+
+    if ids:
+        now = datetime.now()
+        session.execute(
+            insert(UserChange),
+            [{"user_id": id_, "op": op, "created_at": now} for id_ in ids],
+        )
+    session.info["user_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def changes_committed(session: Session):
+    global local_commits
+    if not session.info.pop("user_changed", False):
+        return
+
+    with commits_lock:
+        local_commits += 1
+        maintain = local_commits % CHANGE_LOG_MAINTAIN_EVERY == 0
+    if maintain:
+        Thread(target=maintain_change_log, daemon=True).start()
+
+
+@event.listens_for(Session, "after_rollback")
+def changes_rolled_back(session: Session):
+    session.info.pop("user_changed", None)
+
+
+def get_counter(session: Session, name: str) -> int:
+    counter = session.get(ChangeCounter, name)
+    return counter.value if counter else 0
+
+
+# entries up to this sequence have been dropped by retention
+def purged_seq(session: Session) -> int:
+    return get_counter(session, "user_change_purged")
+
+
+# never below the purged sequence, retention can drop every entry
+def latest_seq(session: Session) -> int:
+    latest = session.query(func.max(UserChange.seq)).scalar() or 0
+    return max(latest, purged_seq(session))
+
+
+# log entries after since with the current user rows, oldest first
+# returns the changes, the sequence to continue from and whether more are left
+def changes_since(session: Session, since: int, limit: int) -> tuple[list, int, bool]:
+    rows = session.execute(
+        select(UserChange, User)
+        .outerjoin(User, User.id == UserChange.user_id)
+        .where(UserChange.seq > since)
+        .order_by(UserChange.seq)
+        .limit(limit)
+    ).all()
+
+    changes = []
+    for change, user in rows:
+        # a user deleted since this entry has a later delete entry as well
+        if change.op == "upsert" and user is None:
+            continue
+        changes.append(
+            {
+                "seq": change.seq,
+                "op": change.op,
+                "user_id": change.user_id,
+                "user": (
+                    {column: getattr(user, column) for column in USER_COLUMNS}
+                    if user
+                    else None
+                ),
+            }
+        )
+
+    next_since = rows[-1][0].seq if rows else since
+    return changes, next_since, len(rows) == limit
+
+
+def get_changes(session: Session, since: int, limit: int) -> tuple[Response, int]:
+    if since < purged_seq(session):
+        logging.info(f"Changes since {since} are no longer kept.")
+        return (
+            jsonify(
+                {
+                    "message": "Changes since this sequence are no longer kept. "
+                    "Fetch /api/users again and continue from next_since.",
+                    "next_since": latest_seq(session),
+                }
+            ),
+            410,
+        )
+
+    changes, next_since, has_more = changes_since(session, since, limit)
+    logging.info(f"{len(changes)} changes since {since}.")
+    return (
+        jsonify({"changes": changes, "next_since": next_since, "has_more": has_more}),
+        200,
+    )
+
+
+# server-sent events, one "change" event per entry with the sequence as event id
+def stream_changes(since: int):
+    deadline = time.monotonic() + CHANGE_STREAM_MAX_SECONDS
+    sent_at = time.monotonic()
+    yield "retry: 1000\n\n"
+
+    while time.monotonic() < deadline:
+        with Session(engine) as session:
+            if since < purged_seq(session):
+                yield f"event: resync\ndata: {json.dumps({'since': since})}\n\n"
+                return
+            changes, since, has_more = changes_since(session, since, 500)
+
+        for change in changes:
+            yield f"id: {change['seq']}\nevent: change\ndata: {json.dumps(change)}\n\n"
+            sent_at = time.monotonic()
+
+        if not has_more:
+            if time.monotonic() - sent_at > CHANGE_STREAM_KEEP_ALIVE:
+                yield ": keep-alive\n\n"
+                sent_at = time.monotonic()
+            time.sleep(CHANGE_STREAM_POLL_INTERVAL)
+
+
+# compaction: keep only the latest entry per user
+# retention: drop entries older than CHANGE_LOG_RETENTION
+# every shard has its own change log
+def maintain_change_log():
+    for shard_engine in shards.engines:
+        maintain_shard_log(shard_engine)
+
+
+def maintain_shard_log(shard_engine):
+    try:
+        with Session(shard_engine) as session:
+            latest_per_user = select(func.max(UserChange.seq)).group_by(
+                UserChange.user_id
+            )
+            compacted = session.execute(
+                delete(UserChange).where(UserChange.seq.not_in(latest_per_user))
+            ).rowcount
+
+            cutoff = datetime.now() - CHANGE_LOG_RETENTION
+            expired = (
+                session.query(func.max(UserChange.seq))
+                .filter(UserChange.created_at < cutoff)
+                .scalar()
+            )
+            purged = 0
+            if expired:
+                purged = session.execute(
+                    delete(UserChange).where(UserChange.seq <= expired)
+                ).rowcount
+                counter = session.get(ChangeCounter, "user_change_purged")
+                if counter:
+                    counter.value = max(counter.value, expired)
+                else:
+                    session.add(ChangeCounter(name="user_change_purged", value=expired))
+
+            session.commit()
+    except Exception as e:
+        logging.error(f"Error when maintaining the change log: {e}")
+    else:
+        logging.info(f"Change log: {compacted} compacted, {purged} expired.")
+
+
+if __name__ == "__main__":
+    maintain_change_log()
@@ -0,0 +1,307 @@
+import heapq
+import json
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock
+from flask import jsonify, send_file, Response
+from sqlalchemy import create_engine, func, inspect, text, update
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session
+from models import User, engine
+from queries import build_user_rows, user_to_dict, save_users
+from shards import sharded, write_sharded
+import shards
+
+
+# jobs are tracked in a local sqlite file, independent of the user database
+JOBS_DATABASE_URL = os.environ.get("JOBS_DATABASE_URL", "sqlite:///../Database/jobs.db")
+JOBS_RESULT_DIR = os.environ.get("JOBS_RESULT_DIR", "../Database/jobs")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_CHUNK_SIZE = int(os.environ.get("JOB_CHUNK_SIZE", "1000"))
+# running jobs without progress for this long are taken as interrupted
+JOB_STALE_AFTER = timedelta(seconds=float(os.environ.get("JOB_STALE_SECONDS", "300")))
+
+
+class JobBase(DeclarativeBase):
+    logging.info("JobBase model initialised")
+
+
+# Model for job table
+class Job(JobBase):
+    logging.info("Job model initialised")
+    __tablename__ = "job"
+    id: Mapped[str] = mapped_column(primary_key=True)
+    kind: Mapped[str] = mapped_column()  # import / export
+    status: Mapped[str] = mapped_column(index=True)  # queued / running / ...
+    params: Mapped[str] = mapped_column(default="{}")
+    total: Mapped[int] = mapped_column(default=0)
+    processed: Mapped[int] = mapped_column(default=0)
+    error: Mapped[str | None] = mapped_column(default=None)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.now)
+    started_at: Mapped[datetime | None] = mapped_column(default=None)
+    finished_at: Mapped[datetime | None] = mapped_column(default=None)
+    updated_at: Mapped[datetime | None] = mapped_column(default=None)  # heartbeat
+
+
+try:
+    jobs_engine = create_engine(JOBS_DATABASE_URL)
+    JobBase.metadata.create_all(jobs_engine)
+    if "updated_at" not in [c["name"] for c in inspect(jobs_engine).get_columns("job")]:
+        with jobs_engine.begin() as connection:
+            connection.execute(text("ALTER TABLE job ADD COLUMN updated_at DATETIME"))
+    os.makedirs(JOBS_RESULT_DIR, exist_ok=True)
+except Exception as e:
+    logging.critical(f"Error in initialising job table: {e}")
+else:
+    logging.info("Job table initialised.")
+
+
+# the worker pool is only started by the first job submitted in this process
+executor = None
+executor_lock = Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=JOB_WORKERS, thread_name_prefix="job"
+            )
+            logging.info(f"Job worker pool started with {JOB_WORKERS} workers.")
+
+            # pick up jobs that were still queued when the app last stopped
+            with Session(jobs_engine) as session:
+                fail_stale_jobs(session)
+                for (job_id,) in session.query(Job.id).filter(Job.status == "queued"):
+                    executor.submit(run_job, job_id)
+    return executor
+
+
+# running jobs whose worker stopped (e.g. the app was restarted) never finish,
+# they are failed once their progress is stale, imports keep their committed
+# chunks and can be retried
+def fail_stale_jobs(session: Session):
+    now = datetime.now()
+    failed = session.execute(
+        update(Job)
+        .where(
+            Job.status == "running",
+            func.coalesce(Job.updated_at, Job.started_at) < now - JOB_STALE_AFTER,
+        )
+        .values(
+            status="failed",
+            error="Interrupted, submit the job again.",
+            finished_at=now,
+        )
+    ).rowcount
+    session.commit()
+    if failed:
+        logging.info(f"{failed} interrupted job(s) failed.")
+
+
+def input_path(job_id: str) -> str:
+    return os.path.join(JOBS_RESULT_DIR, f"{job_id}.input.json")
+
+
+def result_path(job_id: str) -> str:
+    return os.path.join(JOBS_RESULT_DIR, f"{job_id}.json")
+
+
+def submit_job(kind: str, params: dict, payload=None) -> tuple[Response, int]:
+    job_id = uuid.uuid4().hex
+
+    # the payload goes to a file, the worker reads it back
+    if payload is not None:
+        with open(input_path(job_id), "w") as file:
+            json.dump(payload, file)
+
+    with Session(jobs_engine) as session:
+        session.add(
+            Job(
+                id=job_id,
+                kind=kind,
+                status="queued",
+                params=json.dumps(params),
+                total=len(payload) if payload is not None else 0,
+            )
+        )
+        session.commit()
+
+    get_executor().submit(run_job, job_id)
+    logging.info(f"Job {job_id} ({kind}) queued.")
+
+    response = jsonify(
+        {"job_id": job_id, "status": "queued", "status_url": f"/api/jobs/{job_id}"}
+    )
+    response.headers["Location"] = f"/api/jobs/{job_id}"
+    return response, 202
+
+
+# also the heartbeat of the job, a job failed as stale stops its worker
+def set_progress(job_id: str, **values):
+    with Session(jobs_engine) as session:
+        running = session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "running")
+            .values(**values, updated_at=datetime.now())
+        ).rowcount
+        session.commit()
+    if not running:
+        raise RuntimeError(f"Job {job_id} is no longer running.")
+
+
+# only a running job is finished, one failed as stale stays failed
+def finish_job(job_id: str, **values):
+    with Session(jobs_engine) as session:
+        session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "running")
+            .values(**values, finished_at=datetime.now())
+        )
+        session.commit()
+
+
+def run_job(job_id: str):
+    # claim the job, another worker (or process) may already have it
+    with Session(jobs_engine) as session:
+        claimed = session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "queued")
+            .values(
+                status="running", started_at=datetime.now(), updated_at=datetime.now()
+            )
+        ).rowcount
+        session.commit()
+        job = session.get(Job, job_id)
+        kind, params = job.kind, json.loads(job.params)
+
+    if not claimed:
+        return
+
+    logging.info(f"Job {job_id} ({kind}) started.")
+    try:
+        if kind == "import":
+            run_import(job_id, params)
+        elif kind == "export":
+            run_export(job_id)
+        else:
+            raise ValueError(f"Unknown job kind: {kind}")
+
+    except Exception as e:
+        logging.error(f"Job {job_id} failed: {e}")
+        finish_job(job_id, status="failed", error=str(e))
+
+    else:
+        logging.info(f"Job {job_id} finished.")
+        finish_job(job_id, status="finished")
+
+
+# create_users in chunks, one transaction per chunk
+def run_import(job_id: str, params: dict):
+    with open(input_path(job_id)) as file:
+        rows = build_user_rows(json.load(file))
+
+    on_conflict = params.get("on_conflict", "error")
+    processed = 0
+    for start in range(0, len(rows), JOB_CHUNK_SIZE):
+        chunk = rows[start : start + JOB_CHUNK_SIZE]
+        if sharded():
+            write_sharded(
+                chunk,
+                lambda shard, shard_rows: save_users(shard, shard_rows, on_conflict),
+            )
+        else:
+            with Session(engine) as session:
+                save_users(session, chunk, on_conflict)
+                session.commit()
+        processed += len(chunk)
+        set_progress(job_id, processed=processed)
+
+    with open(result_path(job_id), "w") as file:
+        json.dump({"message": "Users Created", "users": processed}, file)
+    os.remove(input_path(job_id))
+
+
+# build_json_users for the whole table, streamed to a file instead of memory
+# shards are read side by side and merged in id order
+def run_export(job_id: str):
+    sessions = [Session(shard_engine) for shard_engine in shards.engines]
+    try:
+        set_progress(
+            job_id, total=sum(session.query(User).count() for session in sessions)
+        )
+
+        temp_path = f"{result_path(job_id)}.part"
+        with open(temp_path, "w") as file:
+            file.write("[")
+            processed = 0
+            queries = [
+                session.query(User).order_by(User.id).yield_per(JOB_CHUNK_SIZE)
+                for session in sessions
+            ]
+            for user in heapq.merge(*queries, key=lambda user: user.id):
+                if processed:
+                    file.write(",")
+                json.dump(user_to_dict(user), file)
+                processed += 1
+                if processed % JOB_CHUNK_SIZE == 0:
+                    set_progress(job_id, processed=processed)
+            file.write("]")
+    finally:
+        for session in sessions:
+            session.close()
+
+    os.replace(temp_path, result_path(job_id))
+    set_progress(job_id, total=processed, processed=processed)
+
+
+def get_job_status(job_id: str) -> tuple[Response, int]:
+    with Session(jobs_engine) as session:
+        fail_stale_jobs(session)
+        job = session.get(Job, job_id)
+
+    if not job:
+        logging.info(f"No job with id {job_id} found.")
+        return jsonify({"message": "No job found"}), 404
+
+    status = {
+        "job_id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "total": job.total,
+        "processed": job.processed,
+        "progress": round(100 * job.processed / job.total, 1) if job.total else 0,
+        "error": job.error,
+        "created_at": job.created_at.isoformat(),
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.status == "finished":
+        status["result_url"] = f"/api/jobs/{job.id}/result"
+
+    return jsonify(status), 200
+
+
+def get_job_result(job_id: str) -> tuple[Response, int]:
+    with Session(jobs_engine) as session:
+        fail_stale_jobs(session)
+        job = session.get(Job, job_id)
+
+    if not job:
+        logging.info(f"No job with id {job_id} found.")
+        return jsonify({"message": "No job found"}), 404
+
+    if not job.status == "finished":
+        logging.info(f"Job {job_id} has no result yet ({job.status}).")
+        return jsonify({"message": f"Job is {job.status}, no result yet."}), 409
+
+    response = send_file(
+        os.path.abspath(result_path(job_id)),
+        mimetype="application/json",
+        as_attachment=True,
+        download_name=f"{job.kind}-{job_id}.json",
+    )
+    return response, 200
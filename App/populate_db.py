@@ -1,12 +1,11 @@
 import json
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 import logging
-from models import User
+from models import User, engine
+from storage import bulk_insert_users
 
 
 try:
-    engine = create_engine("sqlite:///../Database/database.db")
     session = Session(engine)
 except Exception as e:
     logging.critical(f"[__main__] Database connection failed: {e}")
@@ -17,20 +16,18 @@ else:
 def main():
     with open("../Database/Sources/users.json") as file:
         users = json.load(file)
-        for user in users:
-            create_user(
-                session,
-                user["id"],
-                user["first_name"],
-                user["last_name"],
-                user["company_name"],
-                user["city"],
-                user["state"],
-                user["zip"],
-                user["email"],
-                user["web"],
-                user["age"],
-            )
+
+    # load the whole file in one transaction (COPY on postgresql)
+    try:
+        bulk_insert_users(session, users)
+        session.commit()
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        session.rollback()
+    else:
+        logging.info(f"Data for {len(users)} users created.")
+    finally:
+        session.close()
 
 
 def create_user(
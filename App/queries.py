@@ -1,27 +1,96 @@
-from flask import jsonify, Response
-from sqlalchemy import or_, asc, desc, func, case
+from flask import jsonify, Response, json
+from sqlalchemy import or_, asc, desc, func, case, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session, Query
-from models import User
+from datetime import datetime, timedelta
+from werkzeug.datastructures import ETags
+from models import User, IdempotencyKey
+from storage import USER_COLUMNS, contains, is_postgres, write_users
+from readmodel import current_snapshot
+from changes import record_change
+from sketches import (
+    merge_sketches,
+    record_sketch_changes,
+    shard_sketches,
+    sketches_tracked,
+    start_sketch_build,
+    tracked_rows,
+)
+from shards import scatter, sharded, write_sharded
+from collections import Counter
+from itertools import islice
+import hashlib
+import heapq
 import logging
 
 
-def build_json_user(user):
-    json = jsonify({})
-    try:
-        json = jsonify(
+# how long a stored response is replayed for the same Idempotency-Key
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+
+# fields a client can set, and the columns read back for a single user
+USER_FIELDS = [column for column in USER_COLUMNS if not column == "id"]
+USER_ROW = [getattr(User, column) for column in USER_COLUMNS] + [User.version]
+
+
+def user_to_dict(user) -> dict:
+    return {
+        "id": user.id,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "company_name": user.company_name,
+        "city": user.city,
+        "state": user.state,
+        "zip": user.zip,
+        "email": user.email,
+        "web": user.web,
+        "age": user.age,
+    }
+
+
+# rows for bulk_insert_users / upsert_users from a user payload
+def build_user_rows(user_data) -> list[dict]:
+    rows = []
+    for user in user_data:
+        rows.append(
             {
-                "id": user.id,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "company_name": user.company_name,
-                "city": user.city,
-                "state": user.state,
-                "zip": user.zip,
-                "email": user.email,
-                "web": user.web,
-                "age": user.age,
+                "id": user.get("id"),
+                "first_name": user.get("first_name"),
+                "last_name": user.get("last_name"),
+                "company_name": user.get("company_name"),
+                "city": user.get("city"),
+                "state": user.get("state"),
+                "zip": user.get("zip"),
+                "email": user.get("email"),
+                "web": user.get("web"),
+                "age": user.get("age"),
             }
         )
+    return rows
+
+
+# ints sent as strings ("zip": "9999") compare equal to the stored values
+def normalize_value(column: str, value):
+    if column in ("zip", "age") and isinstance(value, str) and value.isdigit():
+        return int(value)
+    return value
+
+
+# row versions sent in If-Match
+def etag_versions(if_match: ETags) -> list[int]:
+    return [int(tag) for tag in if_match.as_set() if tag.isdigit()]
+
+
+# single user row (with version) as json, with the version as ETag
+def build_json_row(row) -> Response:
+    response = jsonify({column: getattr(row, column) for column in USER_COLUMNS})
+    response.set_etag(str(row.version))
+    return response
+
+
+def build_json_user(user):
+    json = jsonify({})
+    try:
+        json = jsonify(user_to_dict(user))
 
     except Exception as e:
         logging.error(f"Error when building json for single user: {e}")
@@ -35,21 +104,7 @@ def build_json_users(query: Query) -> Response:
     user_list = []
     json = jsonify({})
     for user in query:
-        print(user)
-        user_list.append(
-            {
-                "id": user.id,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "company_name": user.company_name,
-                "city": user.city,
-                "state": user.state,
-                "zip": user.zip,
-                "email": user.email,
-                "web": user.web,
-                "age": user.age,
-            }
-        )
+        user_list.append(user_to_dict(user))
 
     try:
         json = jsonify(user_list)
@@ -63,19 +118,137 @@ def build_json_users(query: Query) -> Response:
         return json
 
 
-def search_users(
-    session: Session, search: str = "", sort: str = "id", page: int = 1, limit: int = 5
-) -> tuple[Response, int]:
-    logging.info("Searching users")
-    query = session.query(User)
+# facets a search can be counted by
+FACETS = ("city", "state", "company_name", "age_range")
+
+
+def age_range_case():
+    return case(
+        (User.age.between(0, 18), "0-18"),
+        (User.age.between(19, 30), "19-30"),
+        (User.age.between(31, 45), "31-45"),
+        (User.age.between(46, 60), "46-60"),
+        (User.age > 60, "60+"),
+        else_="Unknown",
+    )
+
+
+# where clause for the search term and the structured filters
+def user_conditions(session: Session, search: str, filters: dict) -> list:
+    conditions = []
     if not search == "":
-        query = query.filter(
+        conditions.append(
             or_(
-                User.first_name.ilike(f"%{search}%"),
-                User.last_name.ilike(f"%{search}%"),
-                User.city.ilike(f"%{search}%"),
+                contains(session, User.first_name, search),
+                contains(session, User.last_name, search),
+                contains(session, User.city, search),
             )
         )
+    for column in ("city", "state", "company_name"):
+        if filters.get(column) is not None:
+            conditions.append(getattr(User, column) == filters[column])
+    if filters.get("age_min") is not None:
+        conditions.append(User.age >= filters["age_min"])
+    if filters.get("age_max") is not None:
+        conditions.append(User.age <= filters["age_max"])
+    return conditions
+
+
+# counts per facet value of the filtered users, grouped per facet
+# (grouping by all facets together would return a row per combination)
+def count_facets(session: Session, conditions: list, facets: list) -> dict:
+    columns = {
+        "city": User.city,
+        "state": User.state,
+        "company_name": User.company_name,
+        "age_range": age_range_case(),
+    }
+    groups = [columns[facet] for facet in facets]
+    counts = {facet: Counter() for facet in facets}
+
+    # postgresql: one query with a grouping set per facet, grouping() tells
+    # which facet a row counts (a null value is ambiguous otherwise)
+    if is_postgres(session) and len(groups) > 1:
+        rows = (
+            session.query(
+                *groups,
+                *(func.grouping(group) for group in groups),
+                func.count(User.id),
+            )
+            .filter(*conditions)
+            .group_by(func.grouping_sets(*groups))
+            .all()
+        )
+        for row in rows:
+            for index, facet in enumerate(facets):
+                if row[len(facets) + index] == 0:
+                    counts[facet][row[index]] += row[-1]
+        return counts
+
+    for facet, group in zip(facets, groups):
+        counts[facet].update(
+            dict(
+                session.query(group, func.count(User.id))
+                .filter(*conditions)
+                .group_by(group)
+                .all()
+            )
+        )
+    return counts
+
+
+def build_facets(counts: dict) -> dict:
+    return {
+        facet: [
+            {facet: value, "user_count": count}
+            for value, count in sorted(values.items())
+        ]
+        for facet, values in counts.items()
+    }
+
+
+# one database's matches for a search, ordered by the sort column then id
+# returns the users and the raw facet counts
+def search_shard(
+    session: Session,
+    search: str,
+    filters: dict,
+    sort: str,
+    order,
+    offset: int,
+    limit: int,
+    facets: list | None,
+) -> tuple[list[dict], dict]:
+    conditions = user_conditions(session, search, filters)
+    query = session.query(User).filter(*conditions)
+    query = query.order_by(order(getattr(User, sort)), order(User.id))
+    query = query.offset(offset).limit(limit)
+
+    users = [user_to_dict(user) for user in query]
+    counts = count_facets(session, conditions, facets) if facets else {}
+    return users, counts
+
+
+# sum of value -> count dicts, per name
+def merge_counts(parts) -> dict:
+    merged = {}
+    for part in parts:
+        for name, counts in part.items():
+            merged.setdefault(name, Counter()).update(counts)
+    return merged
+
+
+def search_users(
+    session: Session,
+    search: str = "",
+    sort: str = "id",
+    page: int = 1,
+    limit: int = 5,
+    filters: dict | None = None,
+    facets: list | None = None,
+) -> tuple[Response, int]:
+    logging.info("Searching users")
+    filters = filters or {}
 
     if sort.startswith("-"):
         sort = sort[1:]
@@ -83,28 +256,75 @@ def search_users(
     else:
         order = asc
 
-    try:
-        sort_column = getattr(User, sort)
-
-    except AttributeError:
+    if sort not in USER_COLUMNS:
         logging.info(f"Invalid sort field: '{sort}', using ID(ASC) instead.")
-        sort_column = getattr(User, "id")
+        sort = "id"
         order = asc
 
-    query = query.order_by(order(sort_column))
-    query = query.offset((page - 1) * limit).limit(limit)
+    users, counts = None, None
+
+    # answer from the in-memory read model when it is enabled
+    with current_snapshot() as snapshot:
+        if snapshot and page >= 1 and limit >= 1:
+            users = snapshot.search(
+                search, sort, order == desc, (page - 1) * limit, limit, filters
+            )
+            if facets:
+                counts = build_facets(snapshot.facets(search, filters, facets))
+            logging.info(f"Found {len(users)} users (read model)")
+
+    # every shard returns its first page * limit matches, merged in sort order
+    if users is None and sharded():
+        offset = max((page - 1) * limit, 0)
+        parts = scatter(
+            search_shard, search, filters, sort, order, 0, offset + limit, facets
+        )
+        users = list(
+            islice(
+                heapq.merge(
+                    *(part[0] for part in parts),
+                    key=lambda user: (user[sort], user["id"]),
+                    reverse=order == desc,
+                ),
+                offset,
+                offset + limit,
+            )
+        )
+        if facets:
+            counts = build_facets(merge_counts(part[1] for part in parts))
+        logging.info(f"Found {len(users)} users ({len(parts)} shards)")
+
+    if users is None:
+        users, counts = search_shard(
+            session, search, filters, sort, order, (page - 1) * limit, limit, facets
+        )
+        if facets:
+            counts = build_facets(counts)
+        logging.info(f"Found {len(users)} users")
 
-    query.all()
+    if facets:
+        return jsonify({"users": users, "facets": counts}), 200
 
-    if query.count() == 0:
+    if not users:
         logging.info("No users found.")
         return jsonify({"message": "No users found"}), 200
 
-    logging.info(f"Found {query.count()} users")
-    return build_json_users(query), 200
+    return jsonify(users), 200
 
 
 def search_user_by_id(session: Session, id: int) -> tuple[Response, int]:
+    with current_snapshot() as snapshot:
+        if snapshot:
+            user = snapshot.get(id)
+            if not user:
+                logging.info(f"No user with id {id} found (read model).")
+                return jsonify({"message": "No users found"}), 404
+
+            logging.info(f"User with id {id} found (read model).")
+            response = jsonify(user)
+            response.set_etag(str(snapshot.row_version(id)))
+            return response, 200
+
     query = session.query(User)
     query = query.filter(User.id == id).first()
 
@@ -113,48 +333,27 @@ def search_user_by_id(session: Session, id: int) -> tuple[Response, int]:
         return jsonify({"message": "No users found"}), 404
 
     logging.info(f"User with id {id} found.")
-    return build_json_user(query), 200
+    response = build_json_user(query)
+    response.set_etag(str(query.version))
+    return response, 200
 
 
 def update_user_by_id(
-    session: Session, id: int, new_user: dict
+    session: Session, id: int, new_user: dict, if_match: ETags | None = None
 ) -> tuple[Response, int]:
-    old_user = session.query(User).filter(User.id == id).first()
-
-    if not old_user:
-        logging.info(f"No user with id {id} found.")
-        return (
-            jsonify(
-                {
-                    "message": "No users found with the given id. Try creating a new user instead."
-                }
-            ),
-            404,
-        )
-
-    try:
-        old_user.first_name = new_user.get("first_name")
-        old_user.last_name = new_user.get("last_name")
-        old_user.company_name = new_user.get("company_name")
-        old_user.city = new_user.get("city")
-        old_user.state = new_user.get("state")
-        old_user.zip = new_user.get("zip")
-        old_user.email = new_user.get("email")
-        old_user.web = new_user.get("web")
-        old_user.age = new_user.get("age")
-
-    except Exception as e:
-        logging.error(f"Error when updating user: {e}")
-        return jsonify({"message": f"Error: {e}"}), 404
+    # PUT replaces the whole user, missing fields are not silently set to null
+    missing = [column for column in USER_FIELDS if column not in new_user]
+    if missing:
+        logging.info(f"Missing fields when updating user {id}: {missing}")
+        return jsonify({"message": f"Missing fields: {', '.join(missing)}"}), 400
 
-    else:
-        session.add(old_user)
-        session.commit()
-        logging.info(f"Successfully updated user: {old_user.id}")
-        return build_json_user(old_user), 200
+    return conditional_update(session, id, new_user, if_match)
 
 
 def delete_user_by_id(session: Session, id: int) -> tuple[Response, int]:
+    # the row is locked before it is read, so the values logged for the sketches
+    # are current
+    before = tracked_rows(session, [id], lock=True)
     try:
         query = session.query(User)
         if not query:
@@ -167,16 +366,78 @@ def delete_user_by_id(session: Session, id: int) -> tuple[Response, int]:
         return jsonify({"message": f"Error when Deleting: {e}"}), 404
 
     else:
+        record_change(session, [id], "delete")
+        record_sketch_changes(session, before, {})
         session.commit()
         logging.info(f"Successfully deleted user: {id}")
 
     return jsonify({"message": "User successfully deleted."}), 200
 
 
-def patch_user_by_id(session: Session, id: int, new_user: dict) -> tuple[Response, int]:
-    old_user = session.query(User).filter(User.id == id).first()
+def patch_user_by_id(
+    session: Session, id: int, new_user: dict, if_match: ETags | None = None
+) -> tuple[Response, int]:
+    return conditional_update(session, id, new_user, if_match)
+
+
+# a single UPDATE ... WHERE id=? [AND version=?] RETURNING for PUT and PATCH
+# no-op updates match no row, so nothing is written or committed for them
+def conditional_update(
+    session: Session, id: int, new_user: dict, if_match: ETags | None
+) -> tuple[Response, int]:
+    values = {
+        column: normalize_value(column, new_user[column])
+        for column in USER_FIELDS
+        if column in new_user
+    }
+    conditions = [User.id == id]
+    if if_match and not if_match.star_tag:
+        conditions.append(User.version.in_(etag_versions(if_match)))
+
+    # values the sketches follow, read with the row locked when the update can
+    # change them
+    tracked = values.keys() & {"city", "company_name", "age"}
+    before = tracked_rows(session, [id], lock=True) if tracked else {}
 
-    if not old_user:
+    row = None
+    if values:
+        try:
+            row = session.execute(
+                update(User)
+                .where(
+                    *conditions,
+                    or_(
+                        *(
+                            getattr(User, column).is_distinct_from(value)
+                            for column, value in values.items()
+                        )
+                    ),
+                )
+                .values(**values, version=User.version + 1)
+                .returning(*USER_ROW)
+                .execution_options(synchronize_session=False)
+            ).first()
+            if row:
+                record_change(session, [id])
+                if tracked:
+                    record_sketch_changes(
+                        session, before, {id: (row.city, row.company_name, row.age)}
+                    )
+                session.commit()
+        except Exception as e:
+            logging.error(f"Error when updating user: {e}")
+            session.rollback()
+            return jsonify({"message": f"Error: {e}"}), 404
+
+    if row:
+        logging.info(f"Successfully updated user: {id}")
+        return build_json_row(row), 200
+
+    # nothing updated: unknown user, failed precondition or no change
+    row = session.execute(select(*USER_ROW).where(User.id == id)).first()
+    session.rollback()
+
+    if not row:
         logging.info(f"No user with id {id} found.")
         return (
             jsonify(
@@ -187,87 +448,76 @@ def patch_user_by_id(session: Session, id: int, new_user: dict) -> tuple[Respons
             404,
         )
 
-    try:
-        if "first_name" in new_user:
-            old_user.first_name = new_user.get("first_name")
-        if "last_name" in new_user:
-            old_user.last_name = new_user.get("last_name")
-        if "company_name" in new_user:
-            old_user.company_name = new_user.get("company_name")
-        if "city" in new_user:
-            old_user.city = new_user.get("city")
-        if "state" in new_user:
-            old_user.state = new_user.get("state")
-        if "zip" in new_user:
-            old_user.zip = new_user.get("zip")
-        if "email" in new_user:
-            old_user.email = new_user.get("email")
-        if "web" in new_user:
-            old_user.web = new_user.get("web")
-        if "age" in new_user:
-            old_user.age = new_user.get("age")
-
-    except Exception as e:
-        logging.error(f"Error when patching user: {e}")
-        return jsonify({"message": f"Error: {e}"}), 404
-
-    else:
-        session.add(old_user)
-        session.commit()
-        logging.info(f"Successfully updated user: {old_user.id}")
-        return build_json_user(old_user), 200
-
-
-def get_user_statistics(session: Session) -> tuple[Response, int]:
-    count_by_city = (
-        session.query(User.city, func.count(User.id).label("user_count"))
-        .group_by(User.city)
-        .all()
-    )
-
-    count_by_company = (
-        session.query(User.company_name, func.count(User.id).label("user_count"))
-        .group_by(User.company_name)
-        .all()
-    )
+    if if_match and not if_match.contains(str(row.version)):
+        logging.info(f"User {id} was modified, If-Match {if_match} failed.")
+        return (
+            jsonify({"message": "User was modified, fetch it again and retry."}),
+            412,
+        )
 
-    avg_age = session.query(func.avg(User.age)).scalar()
-
-    total_cities = session.query(func.count(func.distinct(User.city))).scalar()
-
-    total_companies = session.query(
-        func.count(func.distinct(User.company_name))
-    ).scalar()
-
-    age_ranges = (
-        session.query(
-            case(
-                (User.age.between(0, 18), "0-18"),
-                (User.age.between(19, 30), "19-30"),
-                (User.age.between(31, 45), "31-45"),
-                (User.age.between(46, 60), "46-60"),
-                (User.age > 60, "60+"),
-                else_="Unknown",
-            ).label("age_range"),
-            func.count(User.id).label("user_count"),
+    logging.info(f"No changes for user {id}, nothing written.")
+    return build_json_row(row), 200
+
+
+# one database's part of the statistics, merged by get_user_statistics
+# returns the counts per city / company / age range, the users and their age sum
+def statistics_counts(session: Session) -> tuple[dict, int, int]:
+    counts = {}
+    for name, column in (
+        ("city", User.city),
+        ("company", User.company_name),
+        ("age_range", age_range_case()),
+    ):
+        counts[name] = dict(
+            session.query(column, func.count(User.id)).group_by(column).all()
         )
-        .group_by("age_range")
-        .all()
-    )
+    users, age_sum = session.query(
+        func.count(User.id), func.coalesce(func.sum(User.age), 0)
+    ).one()
+    return counts, users, age_sum
+
+
+def get_user_statistics(session: Session, approx: bool = False) -> tuple[Response, int]:
+    # sketches kept up to date by every write, no table scan
+    # exact statistics until every shard has its sketches, built in the background
+    if approx:
+        parts = scatter(shard_sketches) if sharded() else [shard_sketches(session)]
+        if None in parts:
+            logging.info("Sketches not built yet, fetching exact statistics.")
+            start_sketch_build()
+        else:
+            sketches = merge_sketches(parts) if sharded() else parts[0]
+            logging.info("Statistics fetched (approximate).")
+            return jsonify(sketches.statistics()), 200
+
+    with current_snapshot() as snapshot:
+        if snapshot:
+            logging.info("Statistics fetched (read model).")
+            return jsonify(snapshot.statistics()), 200
+
+    # per shard counts, summed up
+    if sharded():
+        parts = scatter(statistics_counts)
+    else:
+        parts = [statistics_counts(session)]
+    counts = merge_counts(part[0] for part in parts)
+    users = sum(part[1] for part in parts)
+    cities = sorted(counts["city"].items())
+    companies = sorted(counts["company"].items())
 
     stats = {
-        "average_age": avg_age,
-        "total_cities": total_cities,
-        "total_companies": total_companies,
+        "average_age": (sum(part[2] for part in parts) / users if users else None),
+        "total_cities": len(cities),
+        "total_companies": len(companies),
         "count_by_city": [
-            {"city": city, "user_count": count} for city, count in count_by_city
+            {"city": city, "user_count": count} for city, count in cities
         ],
         "count_by_company": [
-            {"company": company, "user_count": count}
-            for company, count in count_by_company
+            {"company": company, "user_count": count} for company, count in companies
         ],
         "age_ranges": [
-            {"age_range": range, "user_count": count} for range, count in age_ranges
+            {"age_range": range, "user_count": count}
+            for range, count in sorted(counts["age_range"].items())
         ],
     }
 
@@ -275,49 +525,143 @@ def get_user_statistics(session: Session) -> tuple[Response, int]:
     return jsonify(stats), 200
 
 
-def create_users(user_data, session):
-    for user in user_data:
-        id_ = user.get("id")
-        first_name = user.get("first_name")
-        last_name = user.get("last_name")
-        company_name = user.get("company_name")
-        city = user.get("city")
-        state = user.get("state")
-        zip_ = user.get("zip")
-        email = user.get("email")
-        age = user.get("age")
-        web = user.get("web")
+def get_idempotent_response(
+    session: Session, key: str, request_hash: str
+) -> tuple[Response, int] | None:
+    stored = session.get(IdempotencyKey, key)
+    if not stored or stored.created_at < datetime.now() - IDEMPOTENCY_KEY_TTL:
+        return None
 
-        try:
-            session.add(
-                User(
-                    id=id_,
-                    first_name=first_name,
-                    last_name=last_name,
-                    company_name=company_name,
-                    city=city,
-                    state=state,
-                    zip=zip_,
-                    email=email,
-                    web=web,
-                    age=age,
-                )
+    if not stored.request_hash == request_hash:
+        logging.info(f"Idempotency-Key {key} reused with a different payload.")
+        return (
+            jsonify(
+                {
+                    "message": "Idempotency-Key was already used with a different payload."
+                }
+            ),
+            422,
+        )
+
+    # only visible when sharded, the key is committed before the shards are written
+    if not stored.status_code:
+        logging.info(f"Request with Idempotency-Key {key} still in progress.")
+        return (
+            jsonify(
+                {"message": "A request with this Idempotency-Key is still in progress."}
+            ),
+            409,
+        )
+
+    logging.info(f"Replaying stored response for Idempotency-Key {key}.")
+    response = jsonify(json.loads(stored.response))
+    response.headers["Idempotent-Replayed"] = "true"
+    return response, stored.status_code
+
+
+# write a batch of user rows with its change log and sketch change entries
+# in the current transaction, caller commits
+def save_users(session: Session, rows: list[dict], on_conflict: str = "error"):
+    # upserts can overwrite users, the sketches need their previous values
+    # (a user two requests create at the same time on postgresql has none to lock)
+    before = {}
+    if not on_conflict == "error":
+        before = tracked_rows(
+            session,
+            [row["id"] for row in rows if row.get("id") is not None],
+            lock=True,
+        )
+
+    ids = write_users(session, rows, on_conflict)
+    record_change(session, ids)
+    if sketches_tracked(session):
+        # ignored rows are not in ids and stay as they were
+        before = {id_: before[id_] for id_ in ids if id_ in before}
+        record_sketch_changes(session, before, tracked_rows(session, ids))
+
+
+# a failed sharded request committed its pending key, a retry may run again
+def forget_pending_key(session: Session, key: str):
+    session.query(IdempotencyKey).filter(
+        IdempotencyKey.key == key, IdempotencyKey.status_code == 0
+    ).delete()
+    session.commit()
+
+
+def create_users(user_data, session, on_conflict="error", idempotency_key=None):
+    request_hash = hashlib.sha256(
+        json.dumps([user_data, on_conflict], sort_keys=True).encode()
+    ).hexdigest()
+
+    # a retry with the same key replays the stored result without writing again
+    if idempotency_key:
+        replay = get_idempotent_response(session, idempotency_key, request_hash)
+        if replay:
+            return replay
+
+    rows = build_user_rows(user_data)
+
+    result = {"message": "Users Created"}
+
+    # whole batch in one statement (COPY / INSERT ... ON CONFLICT) and one commit
+    # sharded: one statement per shard, one after another, committed in parallel
+    # once all succeeded
+    stored, pending = None, False
+    try:
+        # the key is inserted (pending) before any user is written: a concurrent
+        # retry conflicts on it and replays this request's result
+        if idempotency_key:
+            session.query(IdempotencyKey).filter(
+                IdempotencyKey.created_at < datetime.now() - IDEMPOTENCY_KEY_TTL
+            ).delete()
+            stored = IdempotencyKey(
+                key=idempotency_key,
+                request_hash=request_hash,
+                status_code=0,
+                response="",
+                created_at=datetime.now(),
+            )
+            session.add(stored)
+            session.flush()
+            # the shards commit on their own, retries see the key as in progress
+            if sharded():
+                session.commit()
+                pending = True
+
+        if sharded():
+            write_sharded(
+                rows,
+                lambda shard, shard_rows: save_users(shard, shard_rows, on_conflict),
             )
-        except Exception as e:
-            logging.error(f"Error: {e}")
-            print(f"Error:{e}")
-            session.rollback()
-            return jsonify({"message": f"Error: {e}"}), 404
         else:
-            logging.info("Data with user id:{id} created.")
-        finally:
-            logging.info("Trying to commit.")
+            save_users(session, rows, on_conflict)
 
-        try:
-            session.commit()
-        except Exception as e:
-            logging.error(f"Error: {e}")
-            session.rollback()
-            return jsonify({"message": f"Error: {e}"}), 404
+        # the stored response is committed together with the users
+        # (after them when sharded, it lives in the DATABASE_URL database)
+        if stored:
+            stored.status_code = 200
+            stored.response = json.dumps(result)
+
+        logging.info("Trying to commit.")
+        session.commit()
+    except IntegrityError as e:
+        session.rollback()
+        if pending:
+            forget_pending_key(session, idempotency_key)
+        # a concurrent request with the same key won the race, replay its result
+        if idempotency_key:
+            replay = get_idempotent_response(session, idempotency_key, request_hash)
+            if replay:
+                return replay
+        logging.error(f"Error: {e}")
+        return jsonify({"message": f"Error: {e}"}), 404
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        session.rollback()
+        if pending:
+            forget_pending_key(session, idempotency_key)
+        return jsonify({"message": f"Error: {e}"}), 404
+    else:
+        logging.info(f"Data for {len(rows)} users created.")
 
-    return jsonify({"message": "Users Created"}), 200
+    return jsonify(result), 200
@@ -0,0 +1,402 @@
+import bisect
+import logging
+import os
+import time
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from models import User, UserChange, engine
+from storage import USER_COLUMNS
+from shards import sharded
+import changes
+
+
+# optional in-process copy of the user table for read-heavy serving
+READ_MODEL = os.environ.get("READ_MODEL", "0") == "1"
+# seconds a snapshot is served before the change counter is checked again
+READ_MODEL_MAX_STALENESS = float(os.environ.get("READ_MODEL_MAX_STALENESS", "1.0"))
+# seconds requests use SQL after a failed refresh before it is tried again
+READ_MODEL_RETRY_SECONDS = float(os.environ.get("READ_MODEL_RETRY_SECONDS", "30"))
+
+# int columns are stored in arrays, repeated strings as codes into a dictionary
+INT_COLUMNS = ("id", "zip", "age", "version")
+INTERNED_COLUMNS = ("company_name", "city", "state")
+TEXT_COLUMNS = ("first_name", "last_name", "email", "web")
+# user columns plus the row version
+LOADED_COLUMNS = USER_COLUMNS + ["version"]
+
+AGE_RANGES = ((0, 18, "0-18"), (19, 30, "19-30"), (31, 45, "31-45"), (46, 60, "46-60"))
+
+
+def age_range(age) -> str:
+    for low, high, label in AGE_RANGES:
+        if low <= age <= high:
+            return label
+    if age > 60:
+        return "60+"
+    return "Unknown"
+
+
+# columnar snapshot of the user table
+class Snapshot:
+    def __init__(self):
+        self.columns = {}
+        for column in INT_COLUMNS:
+            self.columns[column] = array("q")
+        for column in INTERNED_COLUMNS:
+            self.columns[column] = array("i")
+        for column in TEXT_COLUMNS:
+            self.columns[column] = []
+
+        # per interned column: list of distinct values and value -> code
+        self.dictionaries = {column: ([], {}) for column in INTERNED_COLUMNS}
+        self.alive = bytearray()
+        self.positions = {}  # id -> row position
+
+        # per sortable column: row positions sorted by (value, id), built on first use
+        self.indexes = {}
+        self.stats = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    # refreshes change a copy, requests keep searching the snapshot they got
+    def copy(self) -> "Snapshot":
+        copied = Snapshot()
+        copied.columns = {column: values[:] for column, values in self.columns.items()}
+        copied.dictionaries = {
+            column: (list(values), dict(codes))
+            for column, (values, codes) in self.dictionaries.items()
+        }
+        copied.alive = bytearray(self.alive)
+        copied.positions = dict(self.positions)
+        # readers may add indexes while this runs, dict() copies them at once
+        copied.indexes = {
+            column: index[:] for column, index in dict(self.indexes).items()
+        }
+        return copied
+
+    def value(self, column: str, position: int):
+        if column in INTERNED_COLUMNS:
+            return self.dictionaries[column][0][self.columns[column][position]]
+        return self.columns[column][position]
+
+    def code(self, column: str, value) -> int:
+        values, codes = self.dictionaries[column]
+        if value not in codes:
+            codes[value] = len(values)
+            values.append(value)
+        return codes[value]
+
+    def sort_key(self, column: str):
+        ids = self.columns["id"]
+        if column in INTERNED_COLUMNS:
+            values = self.dictionaries[column][0]
+            codes = self.columns[column]
+            return lambda position: (values[codes[position]], ids[position])
+        values = self.columns[column]
+        return lambda position: (values[position], ids[position])
+
+    def index(self, column: str) -> array:
+        if column not in self.indexes:
+            positions = [position for position in self.positions.values()]
+            positions.sort(key=self.sort_key(column))
+            self.indexes[column] = array("i", positions)
+            logging.info(f"Read model: sorted index on {column} built.")
+        return self.indexes[column]
+
+    def set_row(self, position: int, row: dict):
+        for column in INT_COLUMNS + TEXT_COLUMNS:
+            self.columns[column][position] = row[column]
+        for column in INTERNED_COLUMNS:
+            self.columns[column][position] = self.code(column, row[column])
+
+    def append_row(self, row: dict) -> int:
+        position = len(self.alive)
+        for column in INT_COLUMNS + TEXT_COLUMNS:
+            self.columns[column].append(row[column])
+        for column in INTERNED_COLUMNS:
+            self.columns[column].append(self.code(column, row[column]))
+        self.alive.append(1)
+        self.positions[row["id"]] = position
+        return position
+
+    # apply changed rows, None marks a deleted id
+    def apply(self, changes: dict):
+        keys = {column: self.sort_key(column) for column in self.indexes}
+        for id_, row in changes.items():
+            position = self.positions.get(id_)
+
+            if position is not None:
+                for column, index in self.indexes.items():
+                    key = keys[column]
+                    del index[bisect.bisect_left(index, key(position), key=key)]
+                if row is None:
+                    self.alive[position] = 0
+                    del self.positions[id_]
+                    continue
+                self.set_row(position, row)
+
+            elif row is None:
+                continue
+            else:
+                position = self.append_row(row)
+
+            for column, index in self.indexes.items():
+                key = keys[column]
+                index.insert(
+                    bisect.bisect_left(index, key(position), key=key), position
+                )
+
+        self.stats = None
+
+    def to_dict(self, position: int) -> dict:
+        return {column: self.value(column, position) for column in USER_COLUMNS}
+
+    def get(self, id_: int) -> dict | None:
+        position = self.positions.get(id_)
+        if position is None:
+            return None
+        return self.to_dict(position)
+
+    def row_version(self, id_: int) -> int:
+        return self.columns["version"][self.positions[id_]]
+
+    def matches(self, position: int, term: str) -> bool:
+        city = self.dictionaries["city"][0][self.columns["city"][position]]
+        return (
+            term in self.columns["first_name"][position].lower()
+            or term in self.columns["last_name"][position].lower()
+            or term in city.lower()
+        )
+
+    # structured filters as interned codes, None when a value is not in the table
+    def filter_codes(self, filters: dict) -> dict | None:
+        codes = {}
+        for column in INTERNED_COLUMNS:
+            if filters.get(column) is not None:
+                code = self.dictionaries[column][1].get(filters[column])
+                if code is None:
+                    return None
+                codes[column] = code
+        return codes
+
+    # positions passing the search term and filters, in index order
+    def filtered(self, index, term: str, filters: dict, codes: dict):
+        ages = self.columns["age"]
+        age_min, age_max = filters.get("age_min"), filters.get("age_max")
+        for position in index:
+            if any(self.columns[c][position] != code for c, code in codes.items()):
+                continue
+            if age_min is not None and ages[position] < age_min:
+                continue
+            if age_max is not None and ages[position] > age_max:
+                continue
+            if term and not self.matches(position, term):
+                continue
+            yield position
+
+    def search(
+        self,
+        search: str,
+        sort: str,
+        descending: bool,
+        offset: int,
+        limit: int,
+        filters: dict | None = None,
+    ) -> list[dict]:
+        filters = {
+            key: value for key, value in (filters or {}).items() if value is not None
+        }
+        index = self.index(sort)
+        if search == "" and not filters:
+            if descending:
+                start = len(index) - offset
+                positions = index[max(start - limit, 0) : max(start, 0)][::-1]
+            else:
+                positions = index[offset : offset + limit]
+            return [self.to_dict(position) for position in positions]
+
+        codes = self.filter_codes(filters)
+        if codes is None:
+            return []
+
+        # walk the sorted index and stop once the page is full
+        users = []
+        positions = reversed(index) if descending else index
+        for position in self.filtered(positions, search.lower(), filters, codes):
+            if offset:
+                offset -= 1
+                continue
+            users.append(self.to_dict(position))
+            if len(users) == limit:
+                break
+        return users
+
+    # value -> count per facet for the users passing the search term and filters
+    def facets(self, search: str, filters: dict, names: list) -> dict:
+        filters = {key: value for key, value in filters.items() if value is not None}
+        counts = {name: Counter() for name in names}
+        codes = self.filter_codes(filters)
+        if codes is None:
+            return {name: {} for name in names}
+
+        positions = self.positions.values()
+        if search or filters:
+            positions = self.filtered(positions, search.lower(), filters, codes)
+        ages = self.columns["age"]
+        for position in positions:
+            for name in names:
+                if name == "age_range":
+                    counts[name][age_range(ages[position])] += 1
+                else:
+                    counts[name][self.columns[name][position]] += 1
+
+        # codes back to values for the interned columns
+        for name in names:
+            if name in INTERNED_COLUMNS:
+                values = self.dictionaries[name][0]
+                counts[name] = {values[code]: n for code, n in counts[name].items()}
+        return counts
+
+    def statistics(self) -> dict:
+        if self.stats is not None:
+            return self.stats
+
+        positions = list(self.positions.values())
+        ages = self.columns["age"]
+        cities = self.counts("city", positions)
+        companies = self.counts("company_name", positions)
+        ranges = Counter(age_range(ages[position]) for position in positions)
+
+        self.stats = {
+            "average_age": (
+                sum(ages[position] for position in positions) / len(positions)
+                if positions
+                else None
+            ),
+            "total_cities": len(cities),
+            "total_companies": len(companies),
+            "count_by_city": [
+                {"city": city, "user_count": count} for city, count in cities
+            ],
+            "count_by_company": [
+                {"company": company, "user_count": count}
+                for company, count in companies
+            ],
+            "age_ranges": [
+                {"age_range": range, "user_count": count}
+                for range, count in sorted(ranges.items())
+            ],
+        }
+        return self.stats
+
+    # (value, count) pairs of an interned column, sorted by value like GROUP BY
+    def counts(self, column: str, positions: list) -> list:
+        values = self.dictionaries[column][0]
+        codes = self.columns[column]
+        counts = Counter(codes[position] for position in positions)
+        return sorted((values[code], count) for code, count in counts.items())
+
+
+# state of the read model in this process
+snapshot = None
+version = 0  # change log sequence the snapshot reflects
+seen_commits = 0  # changes.local_commits at the last refresh
+failed_at = None  # time.monotonic() of the last failed refresh
+checked_at = 0.0
+lock = Lock()
+
+
+def load(session: Session) -> Snapshot:
+    loaded = Snapshot()
+    columns = [getattr(User, column) for column in LOADED_COLUMNS]
+    for row in session.execute(select(*columns).order_by(User.id)).yield_per(10000):
+        loaded.append_row(row._asdict())
+    # rows are loaded in id order, so the id index is the row order
+    loaded.indexes["id"] = array("i", range(len(loaded.alive)))
+    return loaded
+
+
+def reload_rows(session: Session, ids: set) -> dict:
+    changes = dict.fromkeys(ids)
+    columns = [getattr(User, column) for column in LOADED_COLUMNS]
+    ids = list(ids)
+    for start in range(0, len(ids), 500):
+        query = select(*columns).where(User.id.in_(ids[start : start + 500]))
+        for row in session.execute(query):
+            changes[row.id] = row._asdict()
+    return changes
+
+
+def refresh():
+    global snapshot, version, seen_commits, checked_at
+
+    # writes from this process are visible right away, others within the staleness
+    now = time.monotonic()
+    commits = changes.local_commits
+    if (
+        snapshot is not None
+        and commits == seen_commits
+        and now - checked_at < READ_MODEL_MAX_STALENESS
+    ):
+        return
+
+    with Session(engine) as session:
+        latest = changes.latest_seq(session)
+
+        # entries the snapshot has not seen were dropped by retention: reload all
+        if snapshot is None or changes.purged_seq(session) > version:
+            start = time.perf_counter()
+            snapshot = load(session)
+            logging.info(
+                f"Read model: {len(snapshot)} users loaded in "
+                f"{time.perf_counter() - start:.3f}s."
+            )
+
+        # otherwise reload only the users changed since the last refresh
+        elif latest > version:
+            ids = session.scalars(
+                select(UserChange.user_id).where(UserChange.seq > version).distinct()
+            ).all()
+            updated = snapshot.copy()
+            updated.apply(reload_rows(session, ids))
+            snapshot = updated
+            logging.info(f"Read model: {len(ids)} rows refreshed.")
+
+    version = latest
+    seen_commits = commits
+    checked_at = now
+
+
+# yields the refreshed snapshot, or None when the read model is off
+# it follows a single database, so it is off when users are sharded
+# only the refresh holds the lock, a snapshot is not changed once it is served
+@contextmanager
+def current_snapshot():
+    global failed_at
+    if not READ_MODEL or sharded():
+        yield None
+        return
+    if (
+        failed_at is not None
+        and time.monotonic() - failed_at < READ_MODEL_RETRY_SECONDS
+    ):
+        yield None
+        return
+
+    try:
+        with lock:
+            refresh()
+            current = snapshot
+    except Exception as e:
+        # e.g. a locked database, tried again after READ_MODEL_RETRY_SECONDS
+        logging.error(f"Read model refresh failed, falling back to SQL: {e}")
+        failed_at = time.monotonic()
+        current = None
+    else:
+        failed_at = None
+    yield current
@@ -0,0 +1,76 @@
+# Moves every user to the shard its id hashes to under the current SHARD_URLS
+# usage: SHARD_URLS=<url>,<url>,... python rebalance.py
+# also creates the tables on new shards, so it is the setup step for a new layout:
+# e.g. add shard files to SHARD_URLS (the old database can stay the first one) and run it
+# users are copied before they are deleted, an interrupted run can simply be repeated
+# while it runs, requests for a user being moved can miss it, best run with writes stopped
+import logging
+import os
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from models import Base, User, add_missing_columns, create_search_indexes
+from storage import USER_COLUMNS
+from changes import record_change
+from sketches import record_sketch_changes, tracked_rows
+from queries import save_users
+from shards import shard_of
+import shards
+
+
+REBALANCE_CHUNK_SIZE = int(os.environ.get("REBALANCE_CHUNK_SIZE", "1000"))
+MOVED_COLUMNS = [getattr(User, column) for column in USER_COLUMNS] + [User.version]
+
+
+def prepare(shard_engine):
+    Base.metadata.create_all(shard_engine)
+    add_missing_columns(shard_engine)
+    create_search_indexes(shard_engine)
+
+
+# copy the users to their shards, then delete them here
+def move(source: int, ids: list[int]) -> int:
+    with Session(shards.engines[source]) as session:
+        rows = [
+            row._asdict()
+            for row in session.execute(select(*MOVED_COLUMNS).where(User.id.in_(ids)))
+        ]
+
+    targets = {}
+    for row in rows:
+        targets.setdefault(shard_of(row["id"]), []).append(row)
+    for target, target_rows in targets.items():
+        with Session(shards.engines[target]) as session:
+            save_users(session, target_rows, "update")
+            session.commit()
+
+    with Session(shards.engines[source]) as session:
+        before = tracked_rows(session, ids, lock=True)
+        session.execute(delete(User).where(User.id.in_(ids)))
+        record_change(session, ids, "delete")
+        record_sketch_changes(session, before, {})
+        session.commit()
+    return len(rows)
+
+
+def rebalance() -> int:
+    for shard_engine in shards.engines:
+        prepare(shard_engine)
+
+    moved = 0
+    for source, shard_engine in enumerate(shards.engines):
+        with Session(shard_engine) as session:
+            ids = [
+                id_
+                for id_ in session.scalars(select(User.id)).yield_per(10000)
+                if not shard_of(id_) == source
+            ]
+        logging.info(f"Shard {source}: {len(ids)} users to move.")
+
+        for start in range(0, len(ids), REBALANCE_CHUNK_SIZE):
+            moved += move(source, ids[start : start + REBALANCE_CHUNK_SIZE])
+    return moved
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(f"{rebalance()} users moved across {len(shards.engines)} shards.")
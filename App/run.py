@@ -1,11 +1,11 @@
 # imports for run.py
 import logging
-from flask import Flask, request, jsonify, session as flask_session, json
+from flask import Flask, Response, request, jsonify, session as flask_session
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import jwt
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
+from models import engine
 from queries import (
     search_users,
     search_user_by_id,
@@ -14,8 +14,12 @@ from queries import (
     patch_user_by_id,
     get_user_statistics,
     create_users,
+    FACETS,
 )
-from flasgger import Swagger
+from jobs import submit_job, get_job_status, get_job_result
+from apidocs import spec_response, LazySwagger
+from changes import get_changes, stream_changes
+from shards import shard_engine, sharded
 
 # setting up logging
 logging.basicConfig(
@@ -25,15 +29,6 @@ logging.basicConfig(
 )
 
 
-# connecting to database.db and initialising an engine
-try:
-    engine = create_engine("sqlite:///../Database/database.db")
-except Exception as e:
-    logging.critical(f"[__main__] Database connection failed: {e}")
-else:
-    logging.info("[__main__] Database connection established")
-
-
 # creating app instance
 try:
     app = Flask(__name__)
@@ -53,14 +48,14 @@ limiter = Limiter(
 
 
 # setting up api doc
+# the spec is loaded and compressed once, served with an ETag
 @app.route("/apispec_1.json", methods=["GET"])
 def openapi_spec():
-    with open("../openapi3_0.json") as json_file:
-        file = json.load(json_file)
-    return file, 200
+    return spec_response()
 
 
-swagger = Swagger(app)
+# swagger ui at /apidocs, set up on its first request
+app.wsgi_app = LazySwagger(app.wsgi_app)
 
 
 # Method to verify JWT token
@@ -146,9 +141,29 @@ def fetch_users():
     search = request.args.get(
         "search", "", type=str
     )  # search the table using partial first_name, last_name, city
+    filters = {
+        "city": request.args.get("city", type=str),
+        "state": request.args.get("state", type=str),
+        "company_name": request.args.get("company_name", type=str),
+        "age_min": request.args.get("age_min", type=int),
+        "age_max": request.args.get("age_max", type=int),
+    }  # exact match filters, combined with search
+    facets = request.args.get(
+        "facets", "", type=str
+    )  # comma separated facets to count over the filtered users
+    facets = [facet.strip() for facet in facets.split(",") if facet.strip()]
+
+    unknown = [facet for facet in facets if facet not in FACETS]
+    if unknown:
+        logging.error(f"[/api/users - GET] Invalid facets: {unknown}")
+        session.close()
+        return (
+            jsonify({"error": f"facets must be any of: {', '.join(FACETS)}."}),
+            400,
+        )
 
     # fetch user records
-    result, code = search_users(session, search, sort, page, limit)
+    result, code = search_users(session, search, sort, page, limit, filters, facets)
     if code == 200:
         logging.info("[/api/users - GET] Users retrieved successfully")
     else:
@@ -183,7 +198,20 @@ def add_users():
             400,
         )
 
-    result, code = create_users(user_data, session)
+    # how to handle users whose id already exists: error, update or ignore
+    on_conflict = request.args.get("on_conflict", "error", type=str)
+    if on_conflict not in ("error", "update", "ignore"):
+        logging.error(f"[/api/users - POST] Invalid on_conflict: {on_conflict}")
+        session.close()
+        return (
+            jsonify({"error": "on_conflict must be one of: error, update, ignore."}),
+            400,
+        )
+
+    # retries with the same key replay the first response
+    idempotency_key = request.headers.get("Idempotency-Key")
+
+    result, code = create_users(user_data, session, on_conflict, idempotency_key)
 
     if code == 200:
         logging.info("[/api/users - POST] Users created successfully")
@@ -200,7 +228,7 @@ def add_users():
 @app.route("/api/users/<int:id_>", methods=["GET"])
 @limiter.limit("10 per hour")
 def get_user(id_):
-    session = Session(engine)
+    session = Session(shard_engine(id_))  # the shard that holds the user
     search, code = search_user_by_id(session, id_)
 
     if code == 200:
@@ -228,7 +256,7 @@ def update_user(id_):
     if not code == 200:
         return response, code
 
-    session = Session(engine)
+    session = Session(shard_engine(id_))  # the shard that holds the user
     user_data = request.get_json()
 
     if user_data is None:
@@ -240,7 +268,7 @@ def update_user(id_):
             400,
         )
 
-    response, code = update_user_by_id(session, id_, user_data)
+    response, code = update_user_by_id(session, id_, user_data, request.if_match)
 
     if code == 200:
         logging.info("[/api/users/<id> - PUT] User updated successfully")
@@ -260,7 +288,7 @@ def delete_user(id_):
     if not code == 200:
         return response, code
 
-    session = Session(engine)
+    session = Session(shard_engine(id_))  # the shard that holds the user
     result, code = delete_user_by_id(session, id_)
     logging.error("[/api/users/<id> - DELETE] Error while Deleting user")
 
@@ -287,8 +315,8 @@ def patch_user(id_):
         logging.error("[/api/users/{id} - PATCH] No payload provided")
         return jsonify({"error": "Invalid JSON"}), 400
 
-    session = Session(engine)
-    response, code = patch_user_by_id(session, id_, user_data)
+    session = Session(shard_engine(id_))  # the shard that holds the user
+    response, code = patch_user_by_id(session, id_, user_data, request.if_match)
 
     if code == 200:
         logging.info("[/api/users/<id> - PATCH] User updated successfully")
@@ -309,9 +337,12 @@ def get_statistics():
     if not verify_token(request.headers.get("Authorization"), "/api/summary - GET"):
         return "Invalid token", 401
 
+    # approximate statistics from the sketches instead of scanning the table
+    approx = request.args.get("approx", "false", type=str).lower() == "true"
+
     logging.info("[/api/summary - GET] Getting statistics for db.")
     session = Session(engine)
-    result, code = get_user_statistics(session)
+    result, code = get_user_statistics(session, approx)
     if code == 200:
         logging.info("[/api/summary - GET] Getting statistics for db success.")
     else:
@@ -337,3 +368,140 @@ def get_statistics():
     # }
     session.close()
     return result, code
+
+
+# Queue a background import of ALL the given users
+@app.route("/api/jobs/import", methods=["POST"])
+def add_import_job():
+    response, code = verify_token(
+        request.headers.get("Authorization"), "/api/jobs/import - POST"
+    )
+    if not code == 200:
+        return response, code
+
+    user_data = request.get_json()
+
+    if not isinstance(user_data, list):
+        logging.error(
+            "[/api/jobs/import - POST] Missing or improperly formatted payload."
+        )
+        return (
+            jsonify({"error": "Invalid user data (expected a JSON array of users)."}),
+            400,
+        )
+
+    on_conflict = request.args.get("on_conflict", "error", type=str)
+    if on_conflict not in ("error", "update", "ignore"):
+        logging.error(f"[/api/jobs/import - POST] Invalid on_conflict: {on_conflict}")
+        return (
+            jsonify({"error": "on_conflict must be one of: error, update, ignore."}),
+            400,
+        )
+
+    result, code = submit_job("import", {"on_conflict": on_conflict}, user_data)
+    logging.info(f"[/api/jobs/import - POST] Import job queued: {result.json}")
+    return result, code
+
+
+# Queue a background export of the whole user table
+@app.route("/api/jobs/export", methods=["POST"])
+def add_export_job():
+    response, code = verify_token(
+        request.headers.get("Authorization"), "/api/jobs/export - POST"
+    )
+    if not code == 200:
+        return response, code
+
+    result, code = submit_job("export", {})
+    logging.info(f"[/api/jobs/export - POST] Export job queued: {result.json}")
+    return result, code
+
+
+# Status and progress of the job with ID : job_id
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    response, code = verify_token(
+        request.headers.get("Authorization"), f"/api/jobs/{job_id} - GET"
+    )
+    if not code == 200:
+        return response, code
+
+    result, code = get_job_status(job_id)
+    if not code == 200:
+        logging.error(f"[/api/jobs/{job_id} - GET] Job not found")
+    return result, code
+
+
+# Download the result of the finished job with ID : job_id
+@app.route("/api/jobs/<job_id>/result", methods=["GET"])
+def get_job_download(job_id):
+    response, code = verify_token(
+        request.headers.get("Authorization"), f"/api/jobs/{job_id}/result - GET"
+    )
+    if not code == 200:
+        return response, code
+
+    result, code = get_job_result(job_id)
+    if not code == 200:
+        logging.error(f"[/api/jobs/{job_id}/result - GET] No result: {result.json}")
+    return result, code
+
+
+# Fetch the user changes after the sequence "since"
+@app.route("/api/changes", methods=["GET"])
+def fetch_changes():
+    response, code = verify_token(
+        request.headers.get("Authorization"), "/api/changes - GET"
+    )
+    if not code == 200:
+        return response, code
+
+    # sequences are per database, there is no single feed across shards
+    if sharded():
+        logging.error("[/api/changes - GET] Not available with sharding")
+        return (
+            jsonify({"message": "The change feed is not available with sharding."}),
+            501,
+        )
+
+    since = request.args.get("since", 0, type=int)  # last sequence already seen
+    limit = request.args.get("limit", 100, type=int)  # max log entries per call
+
+    session = Session(engine)
+    result, code = get_changes(session, since, min(max(limit, 1), 1000))
+    if code == 200:
+        logging.info(f"[/api/changes - GET] Changes since {since} retrieved")
+    else:
+        logging.error(f"[/api/changes - GET] Changes since {since} no longer kept")
+
+    session.close()
+    return result, code
+
+
+# Stream the user changes after "since" (or Last-Event-ID) as server-sent events
+@app.route("/api/changes/stream", methods=["GET"])
+def stream_user_changes():
+    response, code = verify_token(
+        request.headers.get("Authorization"), "/api/changes/stream - GET"
+    )
+    if not code == 200:
+        return response, code
+
+    # sequences are per database, there is no single feed across shards
+    if sharded():
+        logging.error("[/api/changes/stream - GET] Not available with sharding")
+        return (
+            jsonify({"message": "The change feed is not available with sharding."}),
+            501,
+        )
+
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None:
+        since = request.args.get("since", 0, type=int)
+
+    logging.info(f"[/api/changes/stream - GET] Streaming changes since {since}")
+    return Response(
+        stream_changes(since),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
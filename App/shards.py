@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from sqlalchemy import case, create_engine, func, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from models import User, ChangeCounter, engine
+
+
+# comma separated database urls, users are hash-partitioned by id across them
+# e.g. SHARD_URLS=sqlite:///../Database/shard0.db,sqlite:///../Database/shard1.db
+# unset: every user is in the DATABASE_URL database, which is also where
+# idempotency keys and the id counter live when sharded
+SHARD_URLS = [url for url in os.environ.get("SHARD_URLS", "").split(",") if url]
+# threads for scatter-gather reads and parallel writes
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", "8"))
+
+try:
+    engines = [create_engine(url) for url in SHARD_URLS] or [engine]
+except Exception as e:
+    logging.critical(f"Error in initialising shards: {e}")
+    engines = [engine]
+else:
+    logging.info(f"{len(engines)} shard(s) initialised.")
+
+executor = None
+executor_lock = Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=SHARD_WORKERS, thread_name_prefix="shard"
+            )
+    return executor
+
+
+def sharded() -> bool:
+    return len(engines) > 1
+
+
+# stable hash of the id, the same in every process
+def shard_of(id_: int, count: int | None = None) -> int:
+    digest = hashlib.blake2b(str(id_).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % (count or len(engines))
+
+
+def shard_engine(id_: int) -> Engine:
+    return engines[shard_of(id_)]
+
+
+def run_on(shard_engine: Engine, function, *args):
+    with Session(shard_engine) as session:
+        return function(session, *args)
+
+
+# function(session, *args) on every shard in parallel, results in shard order
+def scatter(function, *args) -> list:
+    if not sharded():
+        return [run_on(engines[0], function, *args)]
+    futures = [
+        get_executor().submit(run_on, shard_engine, function, *args)
+        for shard_engine in engines
+    ]
+    return [future.result() for future in futures]
+
+
+# ids for new users, unique across shards
+# the counter never goes below the largest id in use or in the batch (floor)
+def allocate_ids(count: int, floor: int = 0) -> list[int]:
+    if not count:
+        return []
+    largest = max(
+        floor,
+        *scatter(lambda session: session.query(func.max(User.id)).scalar() or 0),
+    )
+    # one atomic UPDATE ... RETURNING, concurrent callers are serialised by the
+    # database (a SELECT then UPDATE is not, FOR UPDATE does nothing on sqlite)
+    bump = (
+        update(ChangeCounter)
+        .where(ChangeCounter.name == "user_id")
+        .values(
+            value=case(
+                (ChangeCounter.value > largest, ChangeCounter.value), else_=largest
+            )
+            + count
+        )
+        .returning(ChangeCounter.value)
+        .execution_options(synchronize_session=False)
+    )
+    with Session(engine) as session:
+        last = session.execute(bump).scalar()
+        if last is None:
+            # first allocation, another process may create the counter at the same time
+            try:
+                session.add(ChangeCounter(name="user_id", value=largest + count))
+                session.commit()
+                last = largest + count
+            except IntegrityError:
+                session.rollback()
+                last = session.execute(bump).scalar()
+        session.commit()
+    return list(range(last - count + 1, last + 1))
+
+
+def partition(rows: list[dict]) -> dict[int, list[dict]]:
+    without_id = [row for row in rows if row.get("id") is None]
+    floor = max((row["id"] for row in rows if row.get("id") is not None), default=0)
+    for row, id_ in zip(without_id, allocate_ids(len(without_id), floor)):
+        row["id"] = id_
+
+    parts = {}
+    for row in rows:
+        parts.setdefault(shard_of(row["id"]), []).append(row)
+    return parts
+
+
+# write(session, rows) on the shards of the rows, then commit them in parallel
+# every shard is written first and only then committed, so a failed write
+# leaves no shard changed (a failed commit still can, there is no 2PC)
+# shards are written in index order: concurrent requests take the write locks
+# in the same order and cannot deadlock
+def write_sharded(rows: list[dict], write):
+    parts = partition(rows)
+    sessions = []
+    try:
+        for index in sorted(parts):
+            session = Session(engines[index])
+            sessions.append(session)
+            write(session, parts[index])
+            session.flush()
+
+        for future in [get_executor().submit(s.commit) for s in sessions]:
+            future.result()
+    except Exception:
+        for session in sessions:
+            session.rollback()
+        raise
+    finally:
+        for session in sessions:
+            session.close()
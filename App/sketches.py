@@ -0,0 +1,538 @@
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+from collections import Counter
+from threading import Lock, Thread
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from models import User, UserSketch, UserSketchChange, ChangeCounter
+from storage import select_for_update
+from readmodel import age_range
+import shards
+
+
+# sketch sizes, changing them needs a rebuild (python sketches.py)
+# distinct counts: 2**SKETCH_PRECISION registers, relative error 1.04 / sqrt(registers)
+SKETCH_PRECISION = int(os.environ.get("SKETCH_PRECISION", "11"))
+# counts: SKETCH_DEPTH rows of SKETCH_WIDTH counters, overestimate <= e / width * users
+SKETCH_WIDTH = int(os.environ.get("SKETCH_WIDTH", "1024"))
+SKETCH_DEPTH = int(os.environ.get("SKETCH_DEPTH", "4"))
+# values returned per top list, four times as many are followed as candidates
+SKETCH_TOP_K = int(os.environ.get("SKETCH_TOP_K", "10"))
+# users in the age sample
+SKETCH_SAMPLE_SIZE = int(os.environ.get("SKETCH_SAMPLE_SIZE", "2048"))
+# writers only log their changes, approximate requests merge them into the
+# sketches, and a background merge runs after this many logged changes
+SKETCH_MERGE_EVERY = int(os.environ.get("SKETCH_MERGE_EVERY", "1000"))
+
+# columns with a distinct count and top list
+COUNTED_COLUMNS = ("city", "company_name")
+# z for the 95% error bounds
+Z = 1.96
+
+
+# stable 64 bit hash, python's hash() differs between processes
+def hash64(value, salt: str) -> int:
+    digest = hashlib.blake2b(f"{salt}:{value}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+# distinct values (HyperLogLog), values can be added but not removed
+class HyperLogLog:
+    def __init__(self, registers: list | None = None):
+        self.registers = registers or [0] * (1 << SKETCH_PRECISION)
+
+    # returns whether a register changed
+    def add(self, value) -> bool:
+        hashed = hash64(value, "hll")
+        precision = len(self.registers).bit_length() - 1
+        index = hashed >> (64 - precision)
+        rest = hashed & ((1 << (64 - precision)) - 1)
+        rank = 64 - precision - rest.bit_length() + 1
+        if rank <= self.registers[index]:
+            return False
+        self.registers[index] = rank
+        return True
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        # small cardinalities: linear counting of the empty registers
+        if raw <= 2.5 * m and zeros:
+            return round(m * math.log(m / zeros))
+        return round(raw)
+
+    def error(self) -> int:
+        return math.ceil(Z * 1.04 / math.sqrt(len(self.registers)) * self.estimate())
+
+
+# value counts (count-min sketch) and the values with the largest counts
+# counters go down again on removal, so updates and deletes are exact in the sketch
+class HeavyHitters:
+    def __init__(self, table: list | None = None, candidates: list | None = None):
+        self.table = table or [[0] * SKETCH_WIDTH for _ in range(SKETCH_DEPTH)]
+        self.candidates = candidates or []
+
+    def cells(self, value) -> list[tuple[int, int]]:
+        hashed = hash64(value, "cms")
+        first, second = hashed >> 32, hashed & 0xFFFFFFFF | 1
+        width = len(self.table[0])
+        return [(row, (first + row * second) % width) for row in range(len(self.table))]
+
+    def estimate(self, value) -> int:
+        return min(self.table[row][column] for row, column in self.cells(value))
+
+    def add(self, value, count: int = 1):
+        for row, column in self.cells(value):
+            self.table[row][column] += count
+        if count < 0 or value in self.candidates:
+            return
+
+        # space-saving: a new value replaces the smallest candidate it overtakes
+        if len(self.candidates) < 4 * SKETCH_TOP_K:
+            self.candidates.append(value)
+            return
+        smallest = min(self.candidates, key=self.estimate)
+        if self.estimate(value) > self.estimate(smallest):
+            self.candidates[self.candidates.index(smallest)] = value
+
+    def total(self) -> int:
+        return sum(self.table[0])
+
+    def top(self) -> list[tuple]:
+        counts = [(value, self.estimate(value)) for value in self.candidates]
+        counts = [(value, count) for value, count in counts if count > 0]
+        return sorted(counts, key=lambda item: (-item[1], item[0]))[:SKETCH_TOP_K]
+
+    # counts are never below the true count, and above it by at most this
+    # with probability 1 - e ** -depth
+    def error(self) -> int:
+        return math.ceil(math.e / len(self.table[0]) * self.total())
+
+
+# the age as an int, None for values like "abc" that sqlite stores as they were sent
+def sample_age(age) -> int | None:
+    try:
+        return int(age)
+    except (TypeError, ValueError):
+        return None
+
+
+# uniform sample of ages: the users whose id hash is below a threshold
+# the threshold drops as the table grows, so the sample stays within its size
+class AgeSample:
+    def __init__(self, threshold: int = 2**64, ages: dict | None = None):
+        self.threshold = threshold
+        self.ages = ages or {}  # id -> [hash, age]
+
+    # both return whether the sample changed, most users are not in it
+    # users without an int age are left out, like NULLs in an AVG
+    def set(self, id_: int, age) -> bool:
+        age = sample_age(age)
+        if age is None:
+            return self.remove(id_)
+        rank = hash64(id_, "sample")
+        if rank >= self.threshold:
+            return False
+        self.ages[id_] = [rank, age]
+        if len(self.ages) > SKETCH_SAMPLE_SIZE:
+            largest = max(self.ages, key=lambda key: self.ages[key][0])
+            self.threshold = self.ages.pop(largest)[0]
+        return True
+
+    def remove(self, id_: int) -> bool:
+        return self.ages.pop(id_, None) is not None
+
+
+# one document per column for the counts, one for its distinct count and one
+# for the age sample, so a write only saves the documents it changed
+class Sketches:
+    def __init__(self, documents: dict | None = None):
+        documents = documents or {}
+        self.distinct, self.counts = {}, {}
+        # names of the documents changed since they were loaded
+        self.changed = set()
+        for column in COUNTED_COLUMNS:
+            document = documents.get(column, {})
+            # sketches saved before the registers had their own document
+            distinct = documents.get(f"{column}_distinct")
+            if distinct is None:
+                distinct = document
+                self.changed.add(f"{column}_distinct")
+            self.distinct[column] = HyperLogLog(distinct.get("registers"))
+            self.counts[column] = HeavyHitters(
+                document.get("table"), document.get("candidates")
+            )
+        document = documents.get("age", {})
+        self.sample = AgeSample(
+            document.get("threshold", 2**64),
+            {int(id_): value for id_, value in document.get("ages", {}).items()},
+        )
+
+    def documents(self) -> dict:
+        documents = {}
+        for column in COUNTED_COLUMNS:
+            documents[column] = {
+                "table": self.counts[column].table,
+                "candidates": self.counts[column].candidates,
+            }
+            documents[f"{column}_distinct"] = {
+                "registers": self.distinct[column].registers
+            }
+        documents["age"] = {
+            "threshold": self.sample.threshold,
+            "ages": self.sample.ages,
+        }
+        return documents
+
+    # old / new: (city, company_name, age) of the user, None when not there
+    # only the values that differ are applied
+    def update(self, id_: int, old: tuple | None, new: tuple | None):
+        for index, column in enumerate(COUNTED_COLUMNS):
+            if old is not None and new is not None and old[index] == new[index]:
+                continue
+            if old is not None:
+                self.counts[column].add(old[index], -1)
+            if new is not None:
+                self.counts[column].add(new[index])
+                if self.distinct[column].add(new[index]):
+                    self.changed.add(f"{column}_distinct")
+            self.changed.add(column)
+
+        if old is not None and new is not None and old[2] == new[2]:
+            return
+        sampled = old is not None and self.sample.remove(id_)
+        if new is not None:
+            sampled = self.sample.set(id_, new[2]) or sampled
+        if sampled:
+            self.changed.add("age")
+
+    def statistics(self) -> dict:
+        total = self.counts["city"].total()
+        # samples saved before non-int ages were left out may still have some
+        ages = [sample_age(age) for _, age in self.sample.ages.values()]
+        ages = [age for age in ages if age is not None]
+        sampled = len(ages)
+        # finite population correction, the error is 0 once every user is sampled
+        correction = math.sqrt(max(1 - sampled / total, 0)) if total else 0
+
+        average, average_error = None, None
+        if sampled:
+            average = sum(ages) / sampled
+            variance = sum((age - average) ** 2 for age in ages) / max(sampled - 1, 1)
+            average_error = Z * math.sqrt(variance / sampled) * correction
+
+        ranges = Counter(age_range(age) for age in ages)
+        age_ranges = []
+        for label, count in sorted(ranges.items()):
+            share = count / sampled
+            age_ranges.append(
+                {
+                    "age_range": label,
+                    "user_count": round(share * total),
+                    "error": math.ceil(
+                        Z
+                        * total
+                        * math.sqrt(share * (1 - share) / sampled)
+                        * correction
+                    ),
+                }
+            )
+
+        return {
+            "approximate": True,
+            "total_users": total,
+            "sample_size": sampled,
+            "average_age": average,
+            "average_age_error": average_error,
+            "total_cities": self.distinct["city"].estimate(),
+            "total_cities_error": self.distinct["city"].error(),
+            "total_companies": self.distinct["company_name"].estimate(),
+            "total_companies_error": self.distinct["company_name"].error(),
+            "count_by_city": [
+                {
+                    "city": city,
+                    "user_count": count,
+                    "error": self.counts["city"].error(),
+                }
+                for city, count in self.counts["city"].top()
+            ],
+            "count_by_company": [
+                {
+                    "company": company,
+                    "user_count": count,
+                    "error": self.counts["company_name"].error(),
+                }
+                for company, count in self.counts["company_name"].top()
+            ],
+            "age_ranges": age_ranges,
+        }
+
+
+# once the sketches exist they are kept for good, so only a hit is cached
+# per database, every shard has its own sketches
+built = set()
+# databases whose writers log their changes for the sketches
+tracked = set()
+building = Lock()
+# changes logged by this process, merged in the background every SKETCH_MERGE_EVERY
+logged_changes = 0
+logged_lock = Lock()
+
+
+def sketches_built(session: Session) -> bool:
+    url = str(session.get_bind().url)
+    if url not in built and session.get(UserSketch, "age") is not None:
+        built.add(url)
+    return url in built
+
+
+# from the start of the first build on, the "user_sketch" counter exists
+def sketches_tracked(session: Session) -> bool:
+    url = str(session.get_bind().url)
+    if url not in tracked and (
+        session.get(ChangeCounter, "user_sketch") is not None or sketches_built(session)
+    ):
+        tracked.add(url)
+    return url in tracked
+
+
+def load_sketches(session: Session) -> Sketches:
+    rows = session.execute(select(UserSketch)).scalars()
+    return Sketches({row.name: json.loads(row.data) for row in rows})
+
+
+# serializes merges and builds until the end of the transaction, writers do not
+# take it: a write to a small counter row, FOR UPDATE does nothing on sqlite
+def lock_sketches(session: Session):
+    bumped = session.execute(
+        update(ChangeCounter)
+        .where(ChangeCounter.name == "user_sketch")
+        .values(value=ChangeCounter.value + 1)
+    ).rowcount
+    if not bumped:
+        session.add(ChangeCounter(name="user_sketch", value=1))
+        session.flush()
+
+
+# only the changed documents, all of them when changed_only is False
+def save_sketches(session: Session, sketches: Sketches, changed_only: bool = True):
+    for name, document in sketches.documents().items():
+        if changed_only and name not in sketches.changed:
+            continue
+        data = json.dumps(document)
+        updated = session.execute(
+            update(UserSketch).where(UserSketch.name == name).values(data=data)
+        ).rowcount
+        if not updated:
+            session.add(UserSketch(name=name, data=data))
+    sketches.changed.clear()
+
+
+# the values the sketches follow, per user id
+# lock: the rows stay locked until the end of the transaction, writers read them
+# before they change them, so concurrent writers of a user see each other's values
+def tracked_rows(session: Session, ids: list, lock: bool = False) -> dict:
+    rows = {}
+    ids = list(ids)
+    for start in range(0, len(ids), 500):
+        query = select(User.id, User.city, User.company_name, User.age).where(
+            User.id.in_(ids[start : start + 500])
+        )
+        result = select_for_update(session, query) if lock else session.execute(query)
+        for id_, *values in result:
+            rows[id_] = tuple(values)
+    return rows
+
+
+# log a write for the sketches in the current transaction, caller commits
+# called after record_change: its lock orders the write against a build
+# before / after: tracked values of the written users, missing when not there
+def record_sketch_changes(session: Session, before: dict, after: dict):
+    global logged_changes
+    if not sketches_tracked(session):
+        return
+
+    rows = [
+        {
+            "user_id": id_,
+            "old": None if before.get(id_) is None else json.dumps(before[id_]),
+            "new": None if after.get(id_) is None else json.dumps(after[id_]),
+        }
+        for id_ in before.keys() | after.keys()
+        if not before.get(id_) == after.get(id_)
+    ]
+    if not rows:
+        return
+    session.execute(insert(UserSketchChange), rows)
+
+    with logged_lock:
+        logged_changes += len(rows)
+        merge = logged_changes >= SKETCH_MERGE_EVERY
+        if merge:
+            logged_changes = 0
+    if merge:
+        Thread(target=merge_all_sketch_changes, daemon=True).start()
+
+
+# folds the logged writes into the sketch documents and commits
+def merge_sketch_changes(session: Session):
+    if session.execute(select(UserSketchChange.seq).limit(1)).first() is None:
+        return
+
+    lock_sketches(session)
+    sketches = load_sketches(session)
+    changes = session.execute(
+        select(UserSketchChange).order_by(UserSketchChange.seq)
+    ).scalars()
+    last = None
+    for change in changes:
+        sketches.update(
+            change.user_id,
+            None if change.old is None else tuple(json.loads(change.old)),
+            None if change.new is None else tuple(json.loads(change.new)),
+        )
+        last = change.seq
+    if last is not None:
+        save_sketches(session, sketches)
+        session.execute(delete(UserSketchChange).where(UserSketchChange.seq <= last))
+    session.commit()
+
+
+def merge_all_sketch_changes():
+    try:
+        for shard_engine in shards.engines:
+            with Session(shard_engine) as session:
+                if sketches_built(session):
+                    merge_sketch_changes(session)
+    except Exception as e:
+        logging.error(f"Error when merging sketch changes: {e}")
+
+
+# replaces the current sketches: grouped counts per column and one pass over the ages
+def build_sketches(session: Session):
+    # writers log their changes from here on
+    if session.get(ChangeCounter, "user_sketch") is None:
+        try:
+            session.add(ChangeCounter(name="user_sketch", value=0))
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+    tracked.add(str(session.get_bind().url))
+
+    # the change log lock waits for the writes in flight and holds new ones until
+    # the build commits: a write is either in the scans or logged after them
+    select_for_update(
+        session, select(ChangeCounter).where(ChangeCounter.name == "user")
+    )
+    lock_sketches(session)
+
+    sketches = Sketches()
+    for column in COUNTED_COLUMNS:
+        values = getattr(User, column)
+        for value, count in session.execute(
+            select(values, func.count()).group_by(values)
+        ):
+            sketches.distinct[column].add(value)
+            sketches.counts[column].add(value, count)
+
+    ranked = heapq.nsmallest(
+        SKETCH_SAMPLE_SIZE + 1,
+        (
+            (hash64(id_, "sample"), id_, sample_age(age))
+            for id_, age in session.execute(select(User.id, User.age)).yield_per(10000)
+            if sample_age(age) is not None
+        ),
+    )
+    if len(ranked) > SKETCH_SAMPLE_SIZE:
+        sketches.sample.threshold = ranked.pop()[0]
+    sketches.sample.ages = {id_: [rank, age] for rank, id_, age in ranked}
+
+    session.execute(delete(UserSketch))
+    session.execute(delete(UserSketchChange))
+    save_sketches(session, sketches, changed_only=False)
+    session.commit()
+    built.add(str(session.get_bind().url))
+    logging.info(f"Sketches built for {sketches.counts['city'].total()} users.")
+
+
+# the sketches of one database with the logged writes merged, None until built
+def shard_sketches(session: Session) -> Sketches | None:
+    if not sketches_built(session):
+        return None
+    merge_sketch_changes(session)
+    return load_sketches(session)
+
+
+# builds the sketches of every shard that has none, one build at a time
+def build_missing_sketches():
+    if not building.acquire(blocking=False):
+        return
+    try:
+        for shard_engine in shards.engines:
+            with Session(shard_engine) as session:
+                if not sketches_built(session):
+                    build_sketches(session)
+    except Exception as e:
+        logging.error(f"Error when building sketches: {e}")
+    finally:
+        building.release()
+
+
+# in a background thread, requests answer exactly until it is done
+def start_sketch_build():
+    if not building.locked():
+        Thread(target=build_missing_sketches, daemon=True).start()
+
+
+# sketches of several shards combined into one, as if built over all their users
+def merge_sketches(parts: list[Sketches]) -> Sketches:
+    merged = Sketches()
+    for column in COUNTED_COLUMNS:
+        registers = merged.distinct[column].registers
+        counts = merged.counts[column]
+        for part in parts:
+            for index, rank in enumerate(part.distinct[column].registers):
+                registers[index] = max(registers[index], rank)
+            for row, counters in enumerate(part.counts[column].table):
+                for index, count in enumerate(counters):
+                    counts.table[row][index] += count
+        # the largest candidates of all shards, ranked by the merged counts
+        candidates = {
+            value for part in parts for value in part.counts[column].candidates
+        }
+        counts.candidates = sorted(candidates, key=counts.estimate, reverse=True)[
+            : 4 * SKETCH_TOP_K
+        ]
+
+    # the union of the samples below the lowest threshold is again such a sample
+    threshold = min(part.sample.threshold for part in parts)
+    ranked = heapq.nsmallest(
+        SKETCH_SAMPLE_SIZE + 1,
+        (
+            (rank, id_, age)
+            for part in parts
+            for id_, (rank, age) in part.sample.ages.items()
+            if rank < threshold
+        ),
+    )
+    if len(ranked) > SKETCH_SAMPLE_SIZE:
+        threshold = ranked.pop()[0]
+    merged.sample = AgeSample(
+        threshold, {id_: [rank, age] for rank, id_, age in ranked}
+    )
+    return merged
+
+
+# build, or rebuild e.g. after many deletes (distinct counts do not go down on
+# their own), on every shard
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for shard_engine in shards.engines:
+        with Session(shard_engine) as session:
+            build_sketches(session)
@@ -0,0 +1,171 @@
+import csv
+import io
+import logging
+from sqlalchemy import insert, func, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from models import User
+
+
+# columns of the user table, in the order used for bulk loads
+USER_COLUMNS = [
+    "id",
+    "first_name",
+    "last_name",
+    "company_name",
+    "city",
+    "state",
+    "zip",
+    "email",
+    "web",
+    "age",
+]
+
+
+def is_postgres(session: Session) -> bool:
+    return session.get_bind().dialect.name == "postgresql"
+
+
+# SELECT ... FOR UPDATE, the rows stay locked until the end of the transaction
+# sqlite ignores FOR UPDATE, the query runs after taking the database write lock
+def select_for_update(session: Session, query):
+    if is_postgres(session):
+        return session.execute(query.with_for_update())
+    connection = session.connection()
+    if not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+    return session.execute(query)
+
+
+# case-insensitive "contains" filter
+# postgresql: ILIKE, served by the trigram indexes from models.py
+# sqlite: LIKE is already case-insensitive for ASCII, ilike would wrap both sides in lower()
+def contains(session: Session, column, term: str):
+    if is_postgres(session):
+        return column.ilike(f"%{term}%")
+    return column.like(f"%{term}%")
+
+
+# bulk insert of user rows (dicts) in the current transaction, caller commits
+# returns the ids of the inserted users
+def bulk_insert_users(session: Session, rows: list[dict]) -> list[int]:
+    if not rows:
+        return []
+
+    with_id = [row for row in rows if row.get("id") is not None]
+    without_id = [
+        {key: value for key, value in row.items() if not key == "id"}
+        for row in rows
+        if row.get("id") is None
+    ]
+    ids = [row["id"] for row in with_id]
+
+    # COPY needs an explicit id on every row, otherwise fall back to INSERT
+    if is_postgres(session) and not without_id:
+        copy_users(session, with_id)
+    else:
+        if with_id:
+            session.execute(insert(User), with_id)
+        # rows without an id get one from the database
+        if without_id:
+            ids += session.scalars(insert(User).returning(User.id), without_id).all()
+        logging.info(f"Inserted {len(rows)} users.")
+
+    if is_postgres(session):
+        sync_id_sequence(session)
+    return ids
+
+
+# insert (on_conflict="error") or upsert ("update" / "ignore") a batch of user rows
+# returns the ids of the written users
+def write_users(
+    session: Session, rows: list[dict], on_conflict: str = "error"
+) -> list[int]:
+    if on_conflict == "error":
+        return bulk_insert_users(session, rows)
+    return upsert_users(session, rows, on_conflict)
+
+
+# set-based upsert of user rows in the current transaction, caller commits
+# on_conflict: "update" overwrites the existing row, "ignore" keeps it
+def upsert_users(
+    session: Session, rows: list[dict], on_conflict: str = "update"
+) -> list[int]:
+    # rows without an id can never conflict, insert them as usual
+    new_rows = [row for row in rows if row.get("id") is None]
+    ids = bulk_insert_users(session, new_rows)
+
+    # a single statement cannot touch the same row twice, keep one row per id
+    # (the last one when updating, the first one when ignoring)
+    by_id = {}
+    for row in rows:
+        if row.get("id") is None:
+            continue
+        if on_conflict == "update" or row["id"] not in by_id:
+            by_id[row["id"]] = row
+    if not by_id:
+        return ids
+
+    dialect = postgresql if is_postgres(session) else sqlite
+    statement = dialect.insert(User)
+    if on_conflict == "update":
+        statement = statement.on_conflict_do_update(
+            index_elements=[User.id],
+            set_={
+                **{
+                    column: getattr(statement.excluded, column)
+                    for column in USER_COLUMNS
+                    if not column == "id"
+                },
+                "version": User.version + 1,
+            },
+        )
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=[User.id])
+
+    # ignored rows are not returned, so they are not logged as changed
+    written = session.scalars(statement.returning(User.id), list(by_id.values())).all()
+    logging.info(f"Upserted {len(written)} of {len(by_id)} users ({on_conflict}).")
+
+    if is_postgres(session):
+        sync_id_sequence(session)
+    return ids + written
+
+
+# postgresql fast path: stream the rows through COPY ... FROM STDIN as csv
+def copy_users(session: Session, rows: list[dict]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(
+            [
+                "" if row.get(column) is None else row.get(column)
+                for column in USER_COLUMNS
+            ]
+        )
+    buffer.seek(0)
+
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f'COPY "user" ({", ".join(USER_COLUMNS)}) FROM STDIN WITH (FORMAT csv)',
+            buffer,
+        )
+    finally:
+        cursor.close()
+    logging.info(f"Copied {len(rows)} users.")
+
+
+# explicit ids do not advance the serial sequence on postgresql, move it past max(id)
+# never backwards: ids a concurrent request took but has not committed are not in max(id)
+def sync_id_sequence(session: Session):
+    max_id = session.query(func.max(User.id)).scalar()
+    if max_id is None:
+        return
+    session.execute(
+        text(
+            "SELECT setval(seq, GREATEST(:max_id, COALESCE(pg_sequence_last_value(seq), 0))) "
+            "FROM CAST(pg_get_serial_sequence('\"user\"', 'id') AS regclass) AS seq"
+        ),
+        {"max_id": max_id},
+    )
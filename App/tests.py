@@ -1,12 +1,17 @@
 import pytest
+import time
+import uuid
+from datetime import timedelta
 from flask.testing import FlaskClient
+from sqlalchemy.orm import Session
 
 
 @pytest.fixture
 def client() -> FlaskClient:
-    from run import app
+    from run import app, limiter
 
     app.config["TESTING"] = True
+    limiter.enabled = False
     return app.test_client()
 
 
@@ -33,11 +38,115 @@ def test_user_summary(client):
     assert "total_companies" in data
 
 
+def test_user_summary_approx(client, monkeypatch):
+    import queries
+    import sketches
+
+    token = test_get_auth_token(client)
+    headers = {"Authorization": f"Bearer {token}"}
+    exact = client.get("/api/summary", headers=headers).get_json()
+
+    # no sketches yet: exact statistics while they are built in the background
+    builds = []
+    monkeypatch.setattr(sketches, "sketches_built", lambda session: False)
+    monkeypatch.setattr(queries, "start_sketch_build", lambda: builds.append(1))
+    response = client.get("/api/summary?approx=true", headers=headers)
+    assert response.status_code == 200
+    assert response.get_json() == exact
+    assert builds == [1]
+    monkeypatch.undo()
+
+    sketches.build_missing_sketches()
+    response = client.get("/api/summary?approx=true", headers=headers)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["approximate"] is True
+    assert abs(data["total_cities"] - exact["total_cities"]) <= max(
+        data["total_cities_error"], 1
+    )
+    exact_cities = {city["city"]: city["user_count"] for city in exact["count_by_city"]}
+    for city in data["count_by_city"]:
+        # count-min never undercounts
+        assert exact_cities[city["city"]] <= city["user_count"]
+        assert city["user_count"] <= exact_cities[city["city"]] + city["error"]
+
+    # the sketches follow writes
+    user = {
+        "id": 9400,
+        "first_name": "Sketch",
+        "last_name": "Test",
+        "email": "sketch@example.com",
+        "age": 30,
+        "city": "Sketch City",
+        "state": "ST",
+        "zip": 12345,
+        "company_name": "Sketch Company",
+        "web": "http://sketch.com",
+    }
+    client.post("/api/users?on_conflict=update", json=[user], headers=headers)
+    added = client.get("/api/summary?approx=true", headers=headers).get_json()
+    assert added["total_users"] == data["total_users"] + 1
+
+    client.delete("/api/users/9400", headers=headers)
+    deleted = client.get("/api/summary?approx=true", headers=headers).get_json()
+    assert deleted["total_users"] == data["total_users"]
+
+    # ages that are not ints are left out of the sample
+    sample = sketches.AgeSample()
+    assert sample.set(1, "40") and sample.ages[1][1] == 40
+    assert sample.set(1, "abc") and 1 not in sample.ages
+    client.post("/api/users", json=[{**user, "age": "abc"}], headers=headers)
+    response = client.get("/api/summary?approx=true", headers=headers)
+    assert response.status_code == 200
+    client.delete("/api/users/9400", headers=headers)
+
+
+def test_openapi_spec_etag(client):
+    response = client.get("/apispec_1.json")
+    assert response.status_code == 200
+    assert "paths" in response.get_json()
+
+    etag = response.headers["ETag"]
+    response = client.get("/apispec_1.json", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
 def test_fetch_users(client):
     response = client.get("/api/users?page=1&limit=5")
     assert response.status_code == 200
 
 
+def test_search_users_case_insensitive(client):
+    response = client.get("/api/users?search=ORLEANS&limit=50")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert isinstance(data, list)
+    assert data  # the seeded users include New Orleans
+    for user in data:
+        assert "orleans" in (
+            f"{user['first_name']} {user['last_name']} {user['city']}".lower()
+        )
+
+
+def test_search_users_facets(client):
+    response = client.get(
+        "/api/users?state=LA&age_min=30&age_max=60&limit=100&facets=city,age_range"
+    )
+    assert response.status_code == 200
+    data = response.get_json()
+    for user in data["users"]:
+        assert user["state"] == "LA"
+        assert 30 <= user["age"] <= 60
+
+    # facet counts cover the whole filtered set, not just the page
+    total = sum(city["user_count"] for city in data["facets"]["city"])
+    assert total == sum(age["user_count"] for age in data["facets"]["age_range"])
+    assert total >= len(data["users"])
+
+    response = client.get("/api/users?facets=zip")
+    assert response.status_code == 400
+
+
 def test_create_user(client):
     token = test_get_auth_token(client)
     headers = {"Authorization": f"Bearer {token}"}
@@ -58,6 +167,435 @@ def test_create_user(client):
     assert response.status_code == 200
 
 
+def test_create_users_upsert(client):
+    token = test_get_auth_token(client)
+    headers = {"Authorization": f"Bearer {token}"}
+    data = [
+        {
+            "id": 9001,
+            "first_name": "Upsert",
+            "last_name": "Test",
+            "email": "upsert@example.com",
+            "age": 30,
+            "city": "Upsert City",
+            "state": "Upsert State",
+            "zip": "9999",
+            "company_name": "Upsert Company",
+            "web": "http://upsert.com",
+        }
+    ]
+    response = client.post("/api/users?on_conflict=update", json=data, headers=headers)
+    assert response.status_code == 200
+
+    data[0]["city"] = "Upsert City 2"
+    response = client.post("/api/users?on_conflict=update", json=data, headers=headers)
+    assert response.status_code == 200
+    assert client.get("/api/users/9001").get_json()["city"] == "Upsert City 2"
+
+    data[0]["city"] = "Upsert City 3"
+    response = client.post("/api/users?on_conflict=ignore", json=data, headers=headers)
+    assert response.status_code == 200
+    assert client.get("/api/users/9001").get_json()["city"] == "Upsert City 2"
+
+    response = client.post("/api/users", json=data, headers=headers)
+    assert response.status_code == 404
+
+
+def test_create_users_idempotency_key(client):
+    token = test_get_auth_token(client)
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": str(uuid.uuid4())}
+    data = [
+        {
+            "first_name": "Idempotent",
+            "last_name": "Test",
+            "email": "idempotent@example.com",
+            "age": 40,
+            "city": "Idempotent City",
+            "state": "Idempotent State",
+            "zip": "9999",
+            "company_name": "Idempotent Company",
+            "web": "http://idempotent.com",
+        }
+    ]
+    response = client.post("/api/users", json=data, headers=headers)
+    assert response.status_code == 200
+
+    response = client.post("/api/users", json=data, headers=headers)
+    assert response.status_code == 200
+    assert response.headers.get("Idempotent-Replayed") == "true"
+
+    data[0]["age"] = 41
+    response = client.post("/api/users", json=data, headers=headers)
+    assert response.status_code == 422
+
+
+def test_create_users_idempotency_key_in_flight(client, monkeypatch):
+    import queries
+    from threading import Event, Thread
+    from run import app
+
+    token = test_get_auth_token(client)
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": str(uuid.uuid4())}
+    email = f"{uuid.uuid4().hex}@example.com"
+    data = [
+        {
+            "first_name": "Race",
+            "last_name": "Test",
+            "email": email,
+            "age": 40,
+            "city": "Race City",
+            "state": "Race State",
+            "zip": "9999",
+            "company_name": "Race Company",
+            "web": "http://race.com",
+        }
+    ]
+
+    # the first request is still writing when the retry arrives
+    writing = Event()
+    save_users = queries.save_users
+
+    def slow_save_users(*args):
+        if not writing.is_set():
+            writing.set()
+            time.sleep(0.5)
+        return save_users(*args)
+
+    monkeypatch.setattr(queries, "save_users", slow_save_users)
+    responses = []
+    first = Thread(
+        target=lambda: responses.append(
+            app.test_client().post("/api/users", json=data, headers=headers)
+        )
+    )
+    first.start()
+    writing.wait(5)
+    responses.append(client.post("/api/users", json=data, headers=headers))
+    first.join()
+
+    assert [response.status_code for response in responses] == [200, 200]
+    replayed = [response.headers.get("Idempotent-Replayed") for response in responses]
+    assert replayed.count("true") == 1
+    users = client.get("/api/users?search=Race&limit=1000").get_json()
+    assert [user["email"] for user in users].count(email) == 1
+
+
+def wait_for_job(client, headers, job_id):
+    for _ in range(200):
+        status = client.get(f"/api/jobs/{job_id}", headers=headers).get_json()
+        if status["status"] in ("finished", "failed"):
+            return status
+        time.sleep(0.05)
+    return status
+
+
+def test_import_job(client):
+    token = test_get_auth_token(client)
+    headers = {"Authorization": f"Bearer {token}"}
+    data = [
+        {
+            "id": 9100 + i,
+            "first_name": "Job",
+            "last_name": f"Import{i}",
+            "email": f"job{i}@example.com",
+            "age": 20 + i,
+            "city": "Job City",
+            "state": "Job State",
+            "zip": "9999",
+            "company_name": "Job Company",
+            "web": "http://job.com",
+        }
+        for i in range(3)
+    ]
+    response = client.post(
+        "/api/jobs/import?on_conflict=update", json=data, headers=headers
+    )
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+
+    status = wait_for_job(client, headers, job_id)
+    assert status["status"] == "finished"
+    assert status["processed"] == 3
+    assert client.get("/api/users/9102").get_json()["last_name"] == "Import2"
+
+
+def test_export_job(client):
+    token = test_get_auth_token(client)
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.post("/api/jobs/export", headers=headers)
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+
+    status = wait_for_job(client, headers, job_id)
+    assert status["status"] == "finished"
+
+    response = client.get(f"/api/jobs/{job_id}/result", headers=headers)
+    assert response.status_code == 200
+    assert len(response.get_json()) == status["processed"]
+
+
+def test_stale_job(client):
+    from datetime import datetime
+    from jobs import Job, JOB_STALE_AFTER, finish_job, jobs_engine
+
+    token = test_get_auth_token(client)
+    headers = {"Authorization": f"Bearer {token}"}
+    started_at = datetime.now() - JOB_STALE_AFTER - timedelta(minutes=1)
+    stale, working = uuid.uuid4().hex, uuid.uuid4().hex
+    with Session(jobs_engine) as session:
+        for job_id, updated_at in ((stale, started_at), (working, datetime.now())):
+            session.add(
+                Job(
+                    id=job_id,
+                    kind="export",
+                    status="running",
+                    started_at=started_at,
+                    updated_at=updated_at,
+                )
+            )
+        session.commit()
+
+    # its worker is gone, it is failed instead of running forever
+    status = client.get(f"/api/jobs/{stale}", headers=headers).get_json()
+    assert status["status"] == "failed"
+    response = client.get(f"/api/jobs/{stale}/result", headers=headers)
+    assert response.status_code == 409
+    # a late worker does not flip it back
+    finish_job(stale, status="finished")
+    status = client.get(f"/api/jobs/{stale}", headers=headers).get_json()
+    assert status["status"] == "failed"
+
+    # long running, but with recent progress
+    status = client.get(f"/api/jobs/{working}", headers=headers).get_json()
+    assert status["status"] == "running"
+    finish_job(working, status="failed", error="test")
+
+
+def test_read_model_matches_sql(client):
+    from run import app
+    from models import engine
+    from readmodel import load
+    from queries import get_user_statistics, search_users
+
+    with app.app_context(), Session(engine) as session:
+        snapshot = load(session)
+
+        stats = get_user_statistics(session)[0].get_json()
+        expected = snapshot.statistics()
+        assert stats.pop("average_age") == pytest.approx(expected["average_age"])
+        assert stats == {k: v for k, v in expected.items() if not k == "average_age"}
+
+        for sort in ("id", "-id", "email"):
+            users = search_users(session, "an", sort, 2, 5)[0].get_json()
+            assert isinstance(users, list) and len(users) == 5
+            assert users == snapshot.search(
+                "an", sort.lstrip("-"), sort.startswith("-"), 5, 5
+            )
+
+        # incremental update keeps the sorted indexes in order
+        user = snapshot.to_dict(snapshot.index("id")[0])
+        snapshot.index("age")
+        snapshot.apply({user["id"]: dict(user, age=1000, version=2)})
+        assert snapshot.search("", "age", True, 0, 1)[0]["id"] == user["id"]
+        snapshot.apply({user["id"]: None})
+        assert snapshot.get(user["id"]) is None
+
+
+def test_read_model_refresh_failure(monkeypatch):
+    import readmodel
+
+    monkeypatch.setattr(readmodel, "READ_MODEL", True)
+    monkeypatch.setattr(readmodel, "READ_MODEL_RETRY_SECONDS", 0)
+    refresh = readmodel.refresh
+
+    def locked():
+        raise RuntimeError("database is locked")
+
+    # one failed refresh falls back to SQL, the next one is tried again
+    monkeypatch.setattr(readmodel, "refresh", locked)
+    with readmodel.current_snapshot() as snapshot:
+        assert snapshot is None
+    monkeypatch.setattr(readmodel, "refresh", refresh)
+    with readmodel.current_snapshot() as snapshot:
+        assert snapshot is not None and len(snapshot)
+
+
+def test_change_feed(client, monkeypatch):
+    import changes
+
+    token = test_get_auth_token(client)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    # skip to the end of the log
+    since = 0
+    while True:
+        data = client.get(f"/api/changes?since={since}&limit=1000", headers=headers)
+        data = data.get_json()
+        since = data["next_since"]
+        if not data["has_more"]:
+            break
+
+    user = {
+        "id": 9200,
+        "first_name": "Feed",
+        "last_name": "Test",
+        "email": "feed@example.com",
+        "age": 50,
+        "city": "Feed City",
+        "state": "Feed State",
+        "zip": "9999",
+        "company_name": "Feed Company",
+        "web": "http://feed.com",
+    }
+    client.post("/api/users?on_conflict=update", json=[user], headers=headers)
+    client.patch("/api/users/9200", json={"age": 51}, headers=headers)
+    changes.maintain_change_log()
+
+    # compaction keeps the latest entry of the user
+    response = client.get(f"/api/changes?since={since}", headers=headers)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [change["user_id"] for change in data["changes"]] == [9200]
+    assert data["changes"][0]["user"]["age"] == 51
+
+    # an ignored upsert writes nothing and logs nothing
+    client.post("/api/users?on_conflict=ignore", json=[user], headers=headers)
+    data = client.get(f"/api/changes?since={since}", headers=headers).get_json()
+    assert [change["user_id"] for change in data["changes"]] == [9200]
+
+    client.delete("/api/users/9200", headers=headers)
+    data = client.get(f"/api/changes?since={since}", headers=headers).get_json()
+    assert [(c["user_id"], c["op"]) for c in data["changes"]] == [(9200, "delete")]
+
+    monkeypatch.setattr(changes, "CHANGE_STREAM_MAX_SECONDS", 0.2)
+    monkeypatch.setattr(changes, "CHANGE_STREAM_POLL_INTERVAL", 0.05)
+    response = client.get(f"/api/changes/stream?since={since}", headers=headers)
+    assert response.mimetype == "text/event-stream"
+    assert "event: change" in response.get_data(as_text=True)
+
+    # retention drops every entry, the client can still resume from next_since
+    monkeypatch.setattr(changes, "CHANGE_LOG_RETENTION", timedelta(seconds=-1))
+    changes.maintain_change_log()
+    response = client.get(f"/api/changes?since={since}", headers=headers)
+    assert response.status_code == 410
+    since = response.get_json()["next_since"]
+    response = client.get(f"/api/changes?since={since}", headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()["changes"] == []
+
+
+def test_sharded_users(client, monkeypatch, tmp_path):
+    import shards
+    import sketches
+    from models import User
+    from rebalance import prepare
+    from sqlalchemy import create_engine
+
+    engines = [create_engine(f"sqlite:///{tmp_path}/shard{n}.db") for n in range(3)]
+    for shard_engine in engines:
+        prepare(shard_engine)
+    monkeypatch.setattr(shards, "engines", engines)
+    # the id counter lives in the DATABASE_URL database, a fresh one per run
+    counter_engine = create_engine(f"sqlite:///{tmp_path}/counter.db")
+    prepare(counter_engine)
+    monkeypatch.setattr(shards, "engine", counter_engine)
+
+    token = test_get_auth_token(client)
+    headers = {"Authorization": f"Bearer {token}"}
+    users = [
+        {
+            "id": 9500 + n,
+            "first_name": "Shard",
+            "last_name": f"User{n}",
+            "email": f"shard{n}@example.com",
+            "age": 20 + n,
+            "city": f"City {n % 2}",
+            "state": "SH",
+            "zip": 12345,
+            "company_name": "Shard Company",
+            "web": "http://shard.com",
+        }
+        for n in range(12)
+    ]
+    users[-1].pop("id")  # gets an id unique across shards
+    response = client.post("/api/users", json=users, headers=headers)
+    assert response.status_code == 200
+
+    # every user is stored once, on the shard its id hashes to
+    stored = []
+    for index, shard_engine in enumerate(engines):
+        with Session(shard_engine) as session:
+            ids = session.scalars(session.query(User.id).statement).all()
+        assert all(shards.shard_of(id_) == index for id_ in ids)
+        stored += ids
+    assert sorted(stored) == list(range(9500, 9512))
+
+    response = client.patch("/api/users/9505", json={"age": 50}, headers=headers)
+    assert response.status_code == 200
+    assert client.get("/api/users/9505").get_json()["age"] == 50
+
+    # pages are merged across shards in sort order
+    ages = []
+    for page in range(1, 4):
+        ages += [
+            user["age"]
+            for user in client.get(f"/api/users?sort=-age&page={page}").get_json()
+        ]
+    assert ages == sorted(
+        [20, 21, 22, 23, 24, 26, 27, 28, 29, 30, 31, 50], reverse=True
+    )
+
+    stats = client.get("/api/summary", headers=headers).get_json()
+    assert stats["count_by_city"] == [
+        {"city": "City 0", "user_count": 6},
+        {"city": "City 1", "user_count": 6},
+    ]
+    sketches.build_missing_sketches()
+    approx = client.get("/api/summary?approx=true", headers=headers).get_json()
+    assert approx["total_users"] == 12
+    assert approx["average_age"] == pytest.approx(stats["average_age"])
+
+
+def test_conditional_update(client):
+    token = test_get_auth_token(client)
+    headers = {"Authorization": f"Bearer {token}"}
+    user = {
+        "id": 9300,
+        "first_name": "Etag",
+        "last_name": "Test",
+        "email": "etag@example.com",
+        "age": 60,
+        "city": "Etag City",
+        "state": "Etag State",
+        "zip": "9999",
+        "company_name": "Etag Company",
+        "web": "http://etag.com",
+    }
+    client.post("/api/users?on_conflict=update", json=[user], headers=headers)
+    etag = client.get("/api/users/9300").headers["ETag"]
+
+    # no-op update keeps the version
+    response = client.patch("/api/users/9300", json={"age": 60}, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["ETag"] == etag
+
+    response = client.patch(
+        "/api/users/9300", json={"age": 61}, headers={**headers, "If-Match": etag}
+    )
+    assert response.status_code == 200
+    assert not response.headers["ETag"] == etag
+
+    # stale version
+    response = client.patch(
+        "/api/users/9300", json={"age": 62}, headers={**headers, "If-Match": etag}
+    )
+    assert response.status_code == 412
+
+    # PUT needs every field
+    response = client.put("/api/users/9300", json={"age": 62}, headers=headers)
+    assert response.status_code == 400
+
+
 def test_fetch_user_by_id(client):
     token = test_get_auth_token(client)
     headers = {"Authorization": f"Bearer {token}"}
@@ -0,0 +1,2 @@
+-- run by the postgres image on first start, see docker-compose.yml
+CREATE DATABASE benchmark;